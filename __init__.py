@@ -8,6 +8,17 @@ from . import payment
 def register():
     Pool.register(
         payment.BankAccount,
+        payment.BankAccountNumber,
+        payment.Party,
+        payment.Address,
+        payment.MoveLine,
         payment.Journal,
         payment.Group,
+        payment.Payment,
+        payment.ImportCSB58ReturnStart,
+        payment.ImportCSB58ReturnResult,
         module='account_payment_es_csb_58', type_='model')
+    Pool.register(
+        payment.ImportCSB58Return,
+        payment.ConsolidateCSB58,
+        module='account_payment_es_csb_58', type_='wizard')
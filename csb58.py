@@ -0,0 +1,649 @@
+# This file is part of account_payment_es_csb_58 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import mmap
+import os
+import re
+import tempfile
+import time
+import unicodedata
+from collections import namedtuple
+from decimal import Decimal
+from functools import lru_cache
+from io import StringIO
+
+__all__ = ['SEPARATOR', 'ENCODING', 'load_retrofix', 'Receipt', 'Template',
+    'receipt_writer', 'iter_ordering_blocks', 'iter_consolidated_records',
+    'iter_records', 'write', 'render', 'render_to_file',
+    'render_consolidated_to_file', 'timed_render_to_file', 'count_blocks',
+    'count_records', 'block_count', 'record_count', 'split',
+    'ReturnedReceipt', 'iter_returns', 'normalize', 'RECORD_LENGTH',
+    'FileTotals', 'InvalidFile', 'validate', 'validate_file']
+
+SEPARATOR = '\r\n'
+ENCODING = 'iso-8859-1'
+# Number of characters of every record without the separator
+RECORD_LENGTH = 162
+
+logger = logging.getLogger(__name__)
+
+
+# Required individual record returned by the bank with a return code
+ReturnedReceipt = namedtuple('ReturnedReceipt', ['reference', 'payment',
+        'amount', 'return_code'])
+# The concept of the receipts starts with the id of its (first) payment
+_payment_id = re.compile(r'\s*(\d+)')
+# Totals of a valid file: ordering blocks, individual records, records and
+# amount
+FileTotals = namedtuple('FileTotals', ['blocks', 'individual_records',
+        'records', 'amount'])
+
+
+class InvalidFile(ValueError):
+    'The CSB 58 file is not internally consistent'
+
+    def __init__(self, line, message):
+        super(InvalidFile, self).__init__('Line %s: %s' % (line, message))
+        self.line = line
+
+
+# Parts of retrofix used to write the records
+Retrofix = namedtuple('Retrofix', ['c58', 'Char', 'Field', 'format_string',
+        'Record'])
+
+
+@lru_cache(maxsize=None)
+def load_retrofix():
+    '''
+    Return the Retrofix used to write the records importing it on first use.
+
+    Loading the format tables of retrofix is the most expensive part of
+    importing this module, so it is left to the processes that write files.
+    '''
+    try:
+        from retrofix import c58
+        from retrofix.fields import Char, Field
+        from retrofix.formatting import format_string
+        from retrofix.record import Record
+    except ImportError:
+        message = ('Unable to import retrofix library.\n'
+                   'Please install it before install this module.')
+        logger.error(message)
+        raise ImportError(message)
+    return Retrofix(c58, Char, Field, format_string, Record)
+
+
+def new_record(structure):
+    'Return a retrofix Record of the c58 structure named structure'
+    retrofix = load_retrofix()
+    return retrofix.Record(getattr(retrofix.c58, structure))
+
+
+@lru_cache(maxsize=16384)
+def normalize(text, size=None):
+    '''
+    Return text as bank safe printable ASCII truncated to size.
+
+    Accents are removed, the characters retrofix would replace are replaced
+    with the same dash and any other character without an ASCII form is
+    dropped. Recurring names and addresses are memoized by their text.
+    '''
+    if not text:
+        return ''
+    text = str(text).replace('\u00b7', '-').replace('+', '-')
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore'
+        ).decode('ascii')
+    text = ' '.join(text.split())
+    return text[:size] if size else text
+
+
+def nif(vat_number):
+    '''
+    Return the 9 characters NIF of vat_number without the ES prefix of its
+    European VAT form, as it is written in the records.
+    '''
+    vat_number = ''.join(vat_number.split()).upper()
+    if vat_number.startswith('ES') and len(vat_number) > 9:
+        vat_number = vat_number[2:]
+    return vat_number
+
+
+@lru_cache(maxsize=16384)
+def format_char(value, size):
+    'Return value normalized and formatted as a Char field of size'
+    return load_retrofix().format_string(normalize(value, size), size)
+
+
+class Receipt(object):
+    '''
+    Scalar values of an individual record of the remittance.
+
+    payment is the id of its (first) payment, it is not written.
+    '''
+    __slots__ = ('reference', 'name', 'bank_account', 'amount', 'concept',
+        'due_date', 'origin_date', 'street', 'city', 'zip', 'province',
+        'records', 'payment')
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+
+class Template(object):
+    """
+    Fixed width record of a retrofix structure compiled once to write many
+    records with the same output as retrofix.record.Record once the text of
+    Char fields is normalized.
+
+    Only the fields named in fields change from record to record, they are
+    the arguments of write in the same order. The rest of the fields take
+    their value from constants, or are left blank, and are formatted once.
+    """
+    __slots__ = ('_parts', '_slots')
+
+    def __init__(self, structure, fields, **constants):
+        retrofix = load_retrofix()
+        self._parts = []
+        self._slots = [None] * len(fields)
+        position = 0
+        for start, size, name, field in structure:
+            if not isinstance(field, retrofix.Field):
+                field = field()
+            field._size = size
+            field._name = name
+            start -= 1
+            if start < position:
+                raise AssertionError('Error compiling field "%s". Start: %d,'
+                    'Current Position: %d' % (name, start, position))
+            self._append(' ' * (start - position))
+            position = start + size
+            if name in fields:
+                self._slots[fields.index(name)] = (len(self._parts),
+                    self._formatter(field))
+                self._parts.append(None)
+            elif type(field) is retrofix.Char:
+                self._append(format_char(constants.get(name), size))
+            else:
+                value = field.get_for_file(field.set(constants.get(name)))
+                if len(value) != size:
+                    raise AssertionError('Field "%s" should be of size "%d" '
+                        'but got "%d".' % (name, size, len(value)))
+                self._append(value)
+        if None in self._slots:
+            raise AssertionError('Fields "%s" do not exist.' % ', '.join(
+                    f for f, s in zip(fields, self._slots) if s is None))
+
+    def _append(self, text):
+        # Join consecutive constant fields in a single literal
+        if not text:
+            return
+        if self._parts and self._parts[-1] is not None:
+            self._parts[-1] += text
+        else:
+            self._parts.append(text)
+
+    @staticmethod
+    def _formatter(field):
+        'Return a function that formats a value of field for the file'
+        if type(field) is load_retrofix().Char:
+            size = field._size
+            return lambda value: format_char(value, size)
+        set_, get_for_file = field.set, field.get_for_file
+        return lambda value: get_for_file(set_(value))
+
+    def write(self, *values):
+        parts = self._parts[:]
+        for (index, formatter), value in zip(self._slots, values):
+            parts[index] = formatter(value)
+        return ''.join(parts)
+
+
+def presenter_header_record(values):
+    record = new_record('PRESENTER_HEADER_RECORD')
+    record.record_code = '51'
+    record.data_code = '70'
+    record.nif = values['vat_code']
+    record.suffix = values['suffix']
+    record.creation_date = values['creation_date']
+    record.name = normalize(values['company_name'])
+    record.bank_code = str(values['bank_account'][0:4])
+    record.bank_office = str(values['bank_account'][4:8])
+    return record.write()
+
+
+def ordering_header_record(values):
+    record = new_record('ORDERING_HEADER_RECORD')
+    record.record_code = '53'
+    record.data_code = '70'
+    record.nif = values['vat_code']
+    record.suffix = values['suffix']
+    record.creation_date = values['creation_date']
+    record.name = normalize(values['company_name'])
+    record.account = values['bank_account']
+    record.procedure = '06'
+    record.ine = values['ine_code'].zfill(9)
+    return record.write()
+
+
+def header_records(values):
+    '''
+    Return the presenter and ordering header records of the remittance
+    described by values.
+
+    They only depend on the journal and the date so they are memoized for
+    all the groups of the same journal.
+    '''
+    return _header_records(values['vat_code'], values['suffix'],
+        values['creation_date'], values['company_name'],
+        values['bank_account'], values['ine_code'])
+
+
+@lru_cache(maxsize=128)
+def _header_records(vat_code, suffix, creation_date, company_name,
+        bank_account, ine_code):
+    values = {
+        'vat_code': vat_code,
+        'suffix': suffix,
+        'creation_date': creation_date,
+        'company_name': company_name,
+        'bank_account': bank_account,
+        'ine_code': ine_code,
+        }
+    return presenter_header_record(values), ordering_header_record(values)
+
+
+def required_individual_template(values):
+    c58 = load_retrofix().c58
+    return Template(c58.REQUIRED_INDIVIDUAL_RECORD, ('reference', 'name',
+            'account', 'amount', 'concept', 'due_date'),
+        record_code='56', data_code='70', nif=values['vat_code'],
+        suffix=values['suffix'], return_code='', internal_code='')
+
+
+def optional_individual_record(values, receipt):
+    record = new_record('OPTIONAL_INDIVIDUAL_RECORD')
+    record.record_code = '56'
+    record.data_code = '71'
+    record.nif = values['vat_code']
+    record.suffix = values['suffix']
+    record.reference = receipt.reference
+    record.concept_2 = ''
+    record.concept_3 = ''
+    record.concept_4 = ''
+    return record.write()
+
+
+def address_individual_template(values):
+    c58 = load_retrofix().c58
+    return Template(c58.ADDRESS_INDIVIDUAL_RECORD, ('reference',
+            'payer_address', 'payer_city', 'payer_zip', 'origin_date'),
+        record_code='56', data_code='76', nif=values['vat_code'],
+        suffix=values['suffix'], ordering_city=values['city'],
+        province_code=values['province'])
+
+
+def ordering_footer_record(values, amount, payment_line_count, record_count):
+    record = new_record('ORDERING_FOOTER_RECORD')
+    record.record_code = '58'
+    record.data_code = '70'
+    record.nif = values['vat_code']
+    record.suffix = values['suffix']
+    record.amount = amount
+    record.payment_line_count = str(payment_line_count)
+    record.record_count = str(record_count)
+    return record.write()
+
+
+def presenter_footer_record(values, ordering_count, amount,
+        payment_line_count, record_count):
+    record = new_record('PRESENTER_FOOTER_RECORD')
+    record.record_code = '59'
+    record.data_code = '70'
+    record.nif = values['vat_code']
+    record.suffix = values['suffix']
+    record.ordering_count = str(ordering_count)
+    record.amount = amount
+    record.payment_line_count = str(payment_line_count)
+    record.record_count = str(record_count)
+    return record.write()
+
+
+def receipt_writer(values):
+    """
+    Return a function that returns the tuple of individual records of a
+    receipt of the remittance described by values
+    """
+    required = required_individual_template(values).write
+    if not values['include_domicile']:
+        return lambda receipt: (required(receipt.reference, receipt.name,
+                receipt.bank_account, receipt.amount, receipt.concept,
+                receipt.due_date),)
+    address = address_individual_template(values).write
+    return lambda receipt: (
+        required(receipt.reference, receipt.name, receipt.bank_account,
+            receipt.amount, receipt.concept, receipt.due_date),
+        address(receipt.reference, receipt.street, receipt.city, receipt.zip,
+            receipt.origin_date))
+
+
+def iter_ordering_blocks(values, totals):
+    '''
+    Yield the ordering blocks of the remittance described by values one
+    record at a time and add their number of blocks, individual records and
+    amount to totals.
+
+    Footers are only built once all the receipts have been consumed, so
+    values['receipts'] may be any iterable. Receipts whose records are
+    already written keep them in their records attribute.
+
+    The receipts are split in ordering blocks of values['block_size']
+    receipts if it is set.
+    '''
+    _, ordering_header = header_records(values)
+    write_receipt = receipt_writer(values)
+    block_size = values.get('block_size') or None
+    blocks = 0
+    block_records = 0
+    block_amount = 0
+    block_receipts = 0
+    for receipt in values['receipts']:
+        if not block_receipts:
+            yield ordering_header
+            blocks += 1
+        records = receipt.records or write_receipt(receipt)
+        for record in records:
+            yield record
+        block_records += len(records)
+        block_amount += abs(receipt.amount)
+        block_receipts += 1
+        if block_receipts == block_size:
+            # The ordering block also counts its own header and footer
+            yield ordering_footer_record(values, block_amount, block_records,
+                block_records + 2)
+            totals[1] += block_records
+            totals[2] += block_amount
+            block_records = block_amount = block_receipts = 0
+    if block_receipts or not blocks:
+        if not blocks:
+            yield ordering_header
+            blocks += 1
+        yield ordering_footer_record(values, block_amount, block_records,
+            block_records + 2)
+        totals[1] += block_records
+        totals[2] += block_amount
+    totals[0] += blocks
+
+
+def iter_consolidated_records(values_list):
+    '''
+    Yield the lines of a single file with the ordering blocks of each of the
+    remittances described by values_list one record at a time.
+
+    The presenter is the one of the first remittance and the totals of its
+    footer are accumulated as the blocks are written.
+    '''
+    presenter = None
+    # Blocks, individual records and amount
+    totals = [0, 0, 0]
+    for values in values_list:
+        if presenter is None:
+            presenter = values
+            yield header_records(values)[0]
+        for record in iter_ordering_blocks(values, totals):
+            yield record
+    if presenter is None:
+        raise ValueError('No remittance to write')
+    blocks, records, amount = totals
+    # The file counts the headers and footers of all the blocks and adds the
+    # presenter header and footer on top of that.
+    yield presenter_footer_record(presenter, blocks, amount, records,
+        records + 2 * blocks + 2)
+
+
+def iter_records(values):
+    'Yield the lines of the remittance one record at a time'
+    return iter_consolidated_records([values])
+
+
+def count_blocks(receipts, block_size=None):
+    'Return the number of ordering blocks of a remittance of receipts'
+    if not block_size:
+        return 1
+    return max(1, -(-receipts // block_size))
+
+
+def count_records(receipts, include_domicile, block_size=None):
+    '''
+    Return the number of records of a file with receipts in blocks of
+    block_size receipts
+    '''
+    per_receipt = 2 if include_domicile else 1
+    return receipts * per_receipt + 2 * count_blocks(receipts, block_size) + 2
+
+
+def block_count(values):
+    'Return the number of ordering blocks of the remittance'
+    return count_blocks(len(values['receipts']), values.get('block_size'))
+
+
+def record_count(values):
+    'Return the number of records of the remittance described by values'
+    return count_records(len(values['receipts']), values['include_domicile'],
+        values.get('block_size'))
+
+
+def split(values, size):
+    '''
+    Yield a copy of values for each chunk of size receipts so each one is
+    written as a separate file with its own amount
+    '''
+    receipts = values['receipts']
+    for start in range(0, len(receipts), size) or [0]:
+        chunk = values.copy()
+        chunk['receipts'] = receipts[start:start + size]
+        chunk['amount'] = sum(abs(r.amount) for r in chunk['receipts'])
+        yield chunk
+
+
+def write(values, stream):
+    'Write the remittance described by values into the text stream'
+    for line in iter_records(values):
+        stream.write(line)
+        stream.write(SEPARATOR)
+
+
+def render(values):
+    'Return the remittance described by values as a string'
+    output = StringIO()
+    write(values, output)
+    return output.getvalue()
+
+
+def render_to_file(values):
+    """
+    Write the remittance described by values encoded into a new temporary
+    file and return its path
+    """
+    return render_consolidated_to_file([values])
+
+
+def render_consolidated_to_file(values_list):
+    """
+    Write the remittances described by values_list encoded into a single
+    new temporary file and return its path
+    """
+    with tempfile.NamedTemporaryFile('wb', prefix='csb58-', suffix='.txt',
+            delete=False) as file_:
+        try:
+            for line in iter_consolidated_records(values_list):
+                # Replacing keeps the records fixed width
+                file_.write((line + SEPARATOR).encode(ENCODING, 'replace'))
+        except Exception:
+            # values_list may be built while it is written and fail
+            file_.close()
+            os.remove(file_.name)
+            raise
+    return file_.name
+
+
+def timed_render_to_file(values):
+    'Return the path of render_to_file and the seconds it took'
+    start = time.perf_counter()
+    path = render_to_file(values)
+    return path, time.perf_counter() - start
+
+
+def iter_returns(file_):
+    """
+    Yield a ReturnedReceipt for each required individual record of the
+    returned remittance in file_, a binary file object, that has a return
+    code.
+
+    The file is read line by line so it is never held in memory. payment is
+    None when the concept does not start with the id of a payment.
+    """
+    for line in file_:
+        # The records are plain ASCII up to the concept
+        if line[:4] != b'5670':
+            continue
+        line = line.decode(ENCODING).rstrip('\r\n')
+        return_code = line[98:104].strip()
+        if not return_code:
+            continue
+        match = _payment_id.match(line[114:154])
+        yield ReturnedReceipt(
+            reference=line[16:28].strip(),
+            payment=int(match.group(1)) if match else None,
+            amount=Decimal(line[88:98]) / 100,
+            return_code=return_code)
+
+
+def _number(line, start, end, number):
+    'Return the unsigned number written between start and end of line'
+    value = line[start:end]
+    if not value.isdigit():
+        raise InvalidFile(number, 'The characters %s to %s are not a number'
+            % (start + 1, end))
+    return int(value)
+
+
+def _check_totals(line, number, totals):
+    """
+    Check the amount, individual records and records of a footer line
+    against totals
+    """
+    for (start, end), total, name in zip(
+            ((88, 98), (104, 114), (114, 124)), totals,
+            ('amount', 'number of individual records', 'number of records')):
+        if _number(line, start, end, number) != total:
+            raise InvalidFile(number, 'The %s of the footer is %s instead '
+                'of %s' % (name, int(line[start:end]), total))
+
+
+def validate(data):
+    """
+    Check that data, the bytes of a CSB 58 file, is internally consistent
+    and return its FileTotals.
+
+    It checks in a single pass that every record has the same width, that
+    the records follow the sequence of the norm, that all the records of a
+    block share the presenter of its header and that the amount and counts
+    of every ordering and presenter footer match the records before it. An
+    InvalidFile is raised on the first inconsistency.
+
+    data may be any object that can be sliced into bytes, like a mmap, and
+    only one record is taken at a time.
+    """
+    separator = SEPARATOR.encode(ENCODING)
+    size = RECORD_LENGTH + len(separator)
+    presenter = None
+    # Presenter of the current ordering block or None outside of blocks
+    ordering = None
+    finished = False
+    blocks = individual_records = records = amount = 0
+    number = 0
+    for number, start in enumerate(range(0, len(data), size), 1):
+        line = data[start:start + size]
+        if len(line) != size or line[-len(separator):] != separator:
+            raise InvalidFile(number, 'The record is not %s characters long'
+                % RECORD_LENGTH)
+        if finished:
+            raise InvalidFile(number, 'The record follows the presenter '
+                'footer')
+        code = line[:4]
+        records += 1
+        if presenter is None:
+            if code != b'5170':
+                raise InvalidFile(number, 'The file does not start with a '
+                    'presenter header')
+            presenter = line[4:16]
+        elif code == b'5370':
+            if ordering is not None:
+                raise InvalidFile(number, 'The ordering header is inside an '
+                    'ordering block')
+            ordering = line[4:16]
+            blocks += 1
+            block_records = block_amount = 0
+            receipt = last_code = None
+        elif code == b'5870' or code[:2] == b'56':
+            if ordering is None:
+                raise InvalidFile(number, 'The record is outside of an '
+                    'ordering block')
+            if line[4:16] != ordering:
+                raise InvalidFile(number, 'The presenter of the record is not '
+                    'the one of its ordering header')
+            if code == b'5670':
+                receipt = line[16:28]
+                block_amount += _number(line, 88, 98, number)
+            elif code == b'5870':
+                # The block also counts its own header and footer
+                _check_totals(line, number,
+                    (block_amount, block_records, block_records + 2))
+                individual_records += block_records
+                amount += block_amount
+                ordering = None
+                continue
+            elif (code < b'5671' or code > b'5676' or receipt is None
+                    or code <= last_code or line[16:28] != receipt):
+                raise InvalidFile(number, 'The individual record %s is out '
+                    'of sequence' % code.decode(ENCODING))
+            last_code = code
+            block_records += 1
+        elif code == b'5970':
+            if ordering is not None:
+                raise InvalidFile(number, 'The ordering block is not closed '
+                    'by a footer')
+            if not blocks:
+                raise InvalidFile(number, 'The file has no ordering block')
+            if line[4:16] != presenter:
+                raise InvalidFile(number, 'The presenter of the footer is '
+                    'not the one of the header')
+            if _number(line, 68, 72, number) != blocks:
+                raise InvalidFile(number, 'The number of ordering blocks of '
+                    'the footer is %s instead of %s' % (int(line[68:72]),
+                        blocks))
+            _check_totals(line, number,
+                (amount, individual_records, records))
+            finished = True
+        else:
+            raise InvalidFile(number, 'The record code %s is unknown'
+                % code.decode(ENCODING))
+    if not finished:
+        raise InvalidFile(number + 1, 'The file does not end with a '
+            'presenter footer')
+    return FileTotals(blocks, individual_records, records,
+        Decimal(amount) / 100)
+
+
+def validate_file(path):
+    """
+    Return the FileTotals of the CSB 58 file at path mapping it into memory
+    so it is read as it is validated
+    """
+    with open(path, 'rb') as file_:
+        if not os.fstat(file_.fileno()).st_size:
+            # Empty files can not be mapped
+            return validate(b'')
+        with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return validate(data)
@@ -2,28 +2,56 @@
 # This file is part of account_payment_es_csb_58 module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
+import hashlib
+import logging
+import os
+import time
+from io import BytesIO
+from decimal import Decimal
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+from trytond import backend
+from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.exceptions import UserError
 from trytond.pool import PoolMeta, Pool
-from trytond.model import fields
+from trytond.model import ModelView, fields
+from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pyson import Eval
-import logging
-import banknumber
-
-try:
-    from retrofix import c58
-    from retrofix.record import Record, write as retrofix_write
-except ImportError:
-    logger = logging.getLogger(__name__)
-    message = ('Unable to import retrofix library.\n'
-               'Please install it before install this module.')
-    logger.error(message)
-    raise Exception(message)
+from trytond.tools import grouped_slice, reduce_ids
+from sql import For, Literal, Null
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Abs
+
+from . import csb58
 
 __all__ = [
     'BankAccount',
+    'BankAccountNumber',
+    'Party',
+    'Address',
+    'MoveLine',
     'Journal',
     'Group',
+    'Payment',
+    'ImportCSB58ReturnStart',
+    'ImportCSB58ReturnResult',
+    'ImportCSB58Return',
+    'ConsolidateCSB58',
     ]
 
+logger = logging.getLogger(__name__)
+
+# Values of a payment read by Group.get_csb58_payment_rows
+Csb58PaymentRow = namedtuple('Csb58PaymentRow', ['id', 'party',
+        'bank_account', 'amount', 'description', 'create_date',
+        'csb58_record', 'csb58_record_date', 'party_name', 'party_code',
+        'maturity_date'])
+
 province = {
     'none': '',
     'ES-VI': '01',
@@ -77,24 +105,371 @@ province = {
 }
 
 
+@lru_cache(maxsize=4096)
+def check_bank_code(code):
+    '''
+    Return whether code is a valid spanish bank account.
+
+    The result only depends on code so it is memoized per process, use
+    check_bank_code.cache_info() to get the hits and misses.
+    '''
+    # Imported on first use as most processes never check a bank code
+    import banknumber
+    return banknumber.check_code('ES', code)
+
+
+class QueryCount(object):
+    'Number of queries run inside a count_queries block'
+    __slots__ = ('value',)
+
+    def __init__(self, value=0):
+        self.value = value
+
+
+class _CountingCursor(object):
+    'Cursor proxy adding each statement it executes to the open counts'
+
+    def __init__(self, cursor, counts):
+        self._cursor = cursor
+        self._counts = counts
+
+    def _count(self):
+        for count in self._counts:
+            count.value += 1
+
+    def execute(self, *args, **kwargs):
+        self._count()
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._count()
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingConnection(object):
+    'Connection proxy whose cursors count the statements they execute'
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.counts = []
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self.connection.cursor(*args, **kwargs),
+            self.counts)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+@contextmanager
+def count_queries(transaction=None):
+    '''
+    Yield a QueryCount of the statements executed inside the block by the
+    cursors of transaction, the current one by default.
+
+    Inside the block the connection of the transaction is replaced by a proxy
+    whose cursors count their statements, so they are counted on any backend.
+    The proxy is shared by the nested blocks, so each one counts all the
+    statements run inside it, and the previous connection is restored when
+    the outermost block exits. Cursors opened before the block are not
+    counted.
+    '''
+    if transaction is None:
+        transaction = Transaction()
+    connection = transaction.connection
+    outermost = not isinstance(connection, _CountingConnection)
+    if outermost:
+        connection = transaction.connection = _CountingConnection(
+            connection)
+    count = QueryCount()
+    connection.counts.append(count)
+    try:
+        yield count
+    finally:
+        connection.counts[:] = [c for c in connection.counts
+            if c is not count]
+        if outermost:
+            transaction.connection = connection.connection
+
+
+class Csb58Stats(object):
+    '''
+    Durations and counters of the generation of the CSB 58 file of a group.
+    '''
+
+    def __init__(self):
+        self.phases = []
+        self.counters = {}
+
+    @contextmanager
+    def phase(self, name):
+        'Record the duration and the queries of the block as phase name'
+        with count_queries() as queries:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.add_phase(name, time.perf_counter() - start,
+                    queries.value)
+
+    def add_phase(self, name, duration, queries=None):
+        self.phases.append((name, duration, queries))
+
+    def add_duration(self, name, duration):
+        'Add duration to the phase called name, adding it if missing'
+        for index, (phase, total, queries) in enumerate(self.phases):
+            if phase == name:
+                self.phases[index] = (phase, total + duration, queries)
+                return
+        self.add_phase(name, duration)
+
+    def __str__(self):
+        items = []
+        for name, duration, queries in self.phases:
+            if queries is None:
+                items.append('%s=%.3fs' % (name, duration))
+            else:
+                items.append('%s=%.3fs/%sq' % (name, duration, queries))
+        items.extend('%s=%s' % i for i in sorted(self.counters.items()))
+        return ' '.join(items)
+
+
+class Csb58Errors(object):
+    '''
+    Index of the errors found building the CSB 58 file of a group.
+
+    Each error message name maps to an ordered dictionary with the offending
+    records, as (model name, id) pairs, and the name shown in the message.
+    '''
+    # Number of records of each error shown in the message
+    limit = 10
+
+    def __init__(self):
+        self.index = OrderedDict()
+
+    def add(self, error, model, id_, name):
+        self.index.setdefault(error, OrderedDict())[(model, id_)] = name
+
+    def records(self, error):
+        'Return the (model name, id) pairs of the records with error'
+        return list(self.index.get(error, ()))
+
+    def __bool__(self):
+        return bool(self.index)
+
+    def __len__(self):
+        return sum(len(r) for r in self.index.values())
+
+    def get_message(self, group):
+        'Return the text with all the errors translated by group'
+        lines = []
+        for error, records in self.index.items():
+            names = list(records.values())
+            # Some messages do not include the name of the record
+            args = '%s' in group._error_messages[error]
+            for name in names[:self.limit]:
+                lines.append(group.raise_user_error(error,
+                        (name,) if args else None, raise_exception=False))
+            if len(names) > self.limit:
+                lines.append(group.raise_user_error('csb58_more_errors',
+                        (len(names) - self.limit,), raise_exception=False))
+        return '\n'.join(lines)
+
+
 class BankAccount(metaclass=PoolMeta):
     __name__ = 'bank.account'
+    _first_other_number_cache = Cache('bank_account.first_other_number',
+        size_limit=10240, context=False)
 
-    def get_first_other_number(self):
+    @staticmethod
+    def _first_other_number(numbers):
         iban = None
-        for number in self.numbers:
-            if number.type == 'other':
-                return number.number
-            elif not iban and number.type == 'iban':
-                iban = number.number
+        for number in numbers:
+            if number['type'] == 'other':
+                return number['number']
+            elif not iban and number['type'] == 'iban':
+                iban = number['number']
         if iban:
             return iban[4:].replace(' ', '')
         return None
 
+    def get_first_other_number(self):
+        return self.get_first_other_numbers([self.id])[self.id]
+
+    @classmethod
+    def get_first_other_numbers(cls, account_ids):
+        """
+        Return a dictionary with the result of get_first_other_number for
+        each account id reading all their numbers at once
+        """
+        Number = Pool().get('bank.account.number')
+        result = {}
+        numbers = {}
+        for account_id in account_ids:
+            number = cls._first_other_number_cache.get(account_id, -1)
+            if number != -1:
+                result[account_id] = number
+            else:
+                numbers[account_id] = []
+        if not numbers:
+            return result
+        for number in Number.search_read([
+                    ('account', 'in', list(numbers)),
+                    ], fields_names=['account', 'type', 'number']):
+            numbers[number['account']].append(number)
+        for account_id, account_numbers in numbers.items():
+            number = cls._first_other_number(account_numbers)
+            cls._first_other_number_cache.set(account_id, number)
+            result[account_id] = number
+        return result
+
+
+class BankAccountNumber(metaclass=PoolMeta):
+    __name__ = 'bank.account.number'
+
+    @classmethod
+    def create(cls, vlist):
+        BankAccount = Pool().get('bank.account')
+        Journal = Pool().get('account.payment.journal')
+        records = super(BankAccountNumber, cls).create(vlist)
+        BankAccount._first_other_number_cache.clear()
+        Journal.clear_csb58_caches(
+            account_ids=[v.get('account') for v in vlist])
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        BankAccount = Pool().get('bank.account')
+        Journal = Pool().get('account.payment.journal')
+        actions = iter(args)
+        account_ids = []
+        for numbers, values in zip(actions, actions):
+            account_ids.extend(n.account.id for n in numbers)
+            account_ids.append(values.get('account'))
+        super(BankAccountNumber, cls).write(*args)
+        BankAccount._first_other_number_cache.clear()
+        Journal.clear_csb58_caches(account_ids=account_ids)
+
+    @classmethod
+    def delete(cls, numbers):
+        BankAccount = Pool().get('bank.account')
+        Journal = Pool().get('account.payment.journal')
+        account_ids = [n.account.id for n in numbers]
+        super(BankAccountNumber, cls).delete(numbers)
+        BankAccount._first_other_number_cache.clear()
+        Journal.clear_csb58_caches(account_ids=account_ids)
+
+
+class _ClearCsb58Caches(object):
+    '''
+    Clear the CSB 58 header values cached by the journals and the records
+    cached by the payments when a party they depend on is changed
+    '''
+
+    @classmethod
+    def _csb58_party_ids(cls, records, values=None):
+        raise NotImplementedError
+
+    @classmethod
+    def create(cls, vlist):
+        Journal = Pool().get('account.payment.journal')
+        records = super(_ClearCsb58Caches, cls).create(vlist)
+        Journal.clear_csb58_caches(
+            party_ids=cls._csb58_party_ids(records))
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        Journal = Pool().get('account.payment.journal')
+        actions = iter(args)
+        party_ids = []
+        for records, values in zip(actions, actions):
+            party_ids.extend(cls._csb58_party_ids(records, values))
+        super(_ClearCsb58Caches, cls).write(*args)
+        Journal.clear_csb58_caches(party_ids=party_ids)
+
+    @classmethod
+    def delete(cls, records):
+        Journal = Pool().get('account.payment.journal')
+        party_ids = cls._csb58_party_ids(records)
+        super(_ClearCsb58Caches, cls).delete(records)
+        Journal.clear_csb58_caches(party_ids=party_ids)
+
+
+class Party(_ClearCsb58Caches, metaclass=PoolMeta):
+    __name__ = 'party.party'
+
+    @classmethod
+    def _csb58_party_ids(cls, parties, values=None):
+        return [p.id for p in parties]
+
+
+class Address(_ClearCsb58Caches, metaclass=PoolMeta):
+    __name__ = 'party.address'
+
+    @classmethod
+    def _csb58_party_ids(cls, addresses, values=None):
+        party_ids = [a.party.id for a in addresses]
+        if values and values.get('party'):
+            # The address is moved to another party
+            party_ids.append(values['party'])
+        return party_ids
+
+
+class MoveLine(metaclass=PoolMeta):
+    __name__ = 'account.move.line'
+
+    @classmethod
+    def write(cls, *args):
+        Payment = Pool().get('account.payment')
+        super(MoveLine, cls).write(*args)
+        actions = iter(args)
+        line_ids = []
+        for lines, values in zip(actions, actions):
+            if 'maturity_date' in values:
+                line_ids.extend(l.id for l in lines)
+        if line_ids:
+            # The due date of the cached records is the maturity date
+            Payment.clear_csb58_records([('line', 'in', line_ids)])
+
 
 class Journal(metaclass=PoolMeta):
     __name__ = 'account.payment.journal'
+    _csb58_header_cache = Cache('account_payment_journal.csb58_header',
+        context=False)
+    _csb58_watched_cache = Cache('account_payment_journal.csb58_watched',
+        context=False)
     csb58_include_domicile = fields.Boolean('Include Domicile')
+    csb58_chunk_size = fields.Integer('Receipts per Chunk',
+        domain=[
+            ['OR',
+                ('csb58_chunk_size', '=', None),
+                ('csb58_chunk_size', '>', 0),
+                ],
+            ],
+        help='Split the receipts of each group in ordering blocks or files '
+        'of this size. Leave it empty to not split them.')
+    csb58_chunk_mode = fields.Selection([
+            ('block', 'Ordering Blocks'),
+            ('file', 'Files'),
+            ], 'Chunk Mode', states={
+            'invisible': ~Eval('csb58_chunk_size'),
+            }, depends=['csb58_chunk_size'])
+    csb58_background = fields.Boolean('Process in Background',
+        help='Queue the groups to be processed by a cron instead of '
+        'building their files when they are processed.')
+    csb58_incremental = fields.Boolean('Incremental',
+        help='Write the records of each payment when it is added to or '
+        'modified in a group that does not join payments, so processing '
+        'the group only has to concatenate them. They are discarded, and '
+        'rendered when the group is processed, if the parties, addresses or '
+        'bank accounts they use change.')
 
     @classmethod
     def __setup__(cls):
@@ -122,6 +497,164 @@ class Journal(metaclass=PoolMeta):
     def default_csb58_include_domicile():
         return False
 
+    def get_csb58_header_values(self):
+        '''
+        Return the values of the CSB 58 files of the journal that do not
+        depend on the group and the list of errors found computing them as
+        the arguments of Csb58Errors.add.
+
+        They are cached until the journal, its party, the company party, one of
+        their addresses or a number of its bank account is modified.
+        '''
+        cached = self._csb58_header_cache.get(self.id)
+        if cached is not None:
+            values, errors = cached
+            return values.copy(), list(errors)
+        Party = Pool().get('party.party')
+        values = {}
+        errors = []
+        values['name'] = self.party.name
+        company = (self.party.__name__, self.party.id, values['name'])
+
+        # Checks bank account code.
+        bank_account = self.sepa_bank_account_number.account
+        code = bank_account and bank_account.get_first_other_number()
+        if not bank_account:
+            errors.append(('bank_account_not_defined',) + company)
+        elif not code or not check_bank_code(code):
+            errors.append(('wrong_bank_account',) + company)
+
+        # Checks vat number
+        vat = self.party and self.party.vat_number or False
+        if not vat:
+            errors.append(('vat_number_not_defined',) + company)
+
+        values['vat_number'] = vat
+        values['vat_code'] = csb58.nif(vat) if vat else vat
+        values['suffix'] = self.suffix
+        values['company_name'] = self.company.party.name
+        values['bank_account'] = code
+        values['ine_code'] = self.ine_code
+        values['include_domicile'] = self.csb58_include_domicile
+        values['block_size'] = (self.csb58_chunk_size
+            if self.csb58_chunk_mode == 'block' else None)
+
+        address = Party.address_get(self.party, type='invoice')
+        if address:
+            values['street'] = address.street
+            values['zip'] = address.zip
+            values['city'] = address.city
+            values['province'] = province[address.subdivision.code
+                    if (address.subdivision
+                        and address.subdivision.type == 'province')
+                    else 'none']
+        # The address records include the city and province of the company
+        if values['include_domicile'] and (not values.get('city')
+                or not values.get('province')):
+            errors.append(('company_without_complete_address',) + company)
+
+        self._csb58_header_cache.set(self.id, (values, errors))
+        return values.copy(), list(errors)
+
+    @classmethod
+    def get_csb58_watched(cls):
+        '''
+        Return the ids of the parties and bank accounts that the cached header
+        values of the CSB 58 journals depend on.
+        '''
+        watched = cls._csb58_watched_cache.get(None)
+        if watched is None:
+            party_ids, account_ids = set(), set()
+            # The set is shared by all the users so it has the journals of
+            # every company
+            with Transaction().set_user(0), \
+                    Transaction().set_context(active_test=False):
+                journals = cls.search([
+                        ('process_method', '=', 'csb58'),
+                        ])
+                for journal in journals:
+                    if journal.party:
+                        party_ids.add(journal.party.id)
+                    party_ids.add(journal.company.party.id)
+                    if journal.sepa_bank_account_number:
+                        account_ids.add(
+                            journal.sepa_bank_account_number.account.id)
+            watched = (sorted(party_ids), sorted(account_ids))
+            cls._csb58_watched_cache.set(None, watched)
+        return set(watched[0]), set(watched[1])
+
+    @classmethod
+    def clear_csb58_caches(cls, party_ids=None, account_ids=None):
+        '''
+        Clear the cached header values and payment records that depend on any
+        of the parties or bank accounts, so unrelated changes do not write
+        them.
+
+        The header values and the records of the payments of a journal depend
+        on its party and the company party, the records of a payment also on
+        its party and bank account.
+        '''
+        Payment = Pool().get('account.payment')
+        party_ids = set(filter(None, party_ids or []))
+        account_ids = set(filter(None, account_ids or []))
+        if not party_ids and not account_ids:
+            return
+        watched_parties, watched_accounts = cls.get_csb58_watched()
+        if watched_parties & party_ids or watched_accounts & account_ids:
+            cls._csb58_header_cache.clear()
+        domain = ['OR']
+        if party_ids:
+            domain.append(('party', 'in', list(party_ids)))
+            if watched_parties & party_ids:
+                domain.extend([
+                        ('journal.party', 'in', list(party_ids)),
+                        ('journal.company.party', 'in', list(party_ids)),
+                        ])
+        if account_ids:
+            domain.append(('bank_account', 'in', list(account_ids)))
+        Payment.clear_csb58_records(domain)
+
+    @staticmethod
+    def default_csb58_chunk_mode():
+        return 'block'
+
+    @staticmethod
+    def default_csb58_background():
+        return False
+
+    @staticmethod
+    def default_csb58_incremental():
+        return False
+
+    @classmethod
+    def create(cls, vlist):
+        journals = super(Journal, cls).create(vlist)
+        cls._csb58_watched_cache.clear()
+        return journals
+
+    @classmethod
+    def write(cls, *args):
+        Payment = Pool().get('account.payment')
+        super(Journal, cls).write(*args)
+        cls._csb58_header_cache.clear()
+        cls._csb58_watched_cache.clear()
+        actions = iter(args)
+        journals = []
+        for records, values in zip(actions, actions):
+            if {'party', 'suffix', 'ine_code', 'csb58_include_domicile',
+                    'csb58_incremental'} & set(values):
+                journals.extend(records)
+        if journals:
+            # The cached records are written with the previous values
+            Payment.clear_csb58_records(
+                [('journal', 'in', [j.id for j in journals])])
+
+    @classmethod
+    def delete(cls, journals):
+        super(Journal, cls).delete(journals)
+        cls._csb58_header_cache.clear()
+        cls._csb58_watched_cache.clear()
+
     @classmethod
     def view_attributes(cls):
         return super(Journal, cls).view_attributes() + [
@@ -132,6 +665,30 @@ class Journal(metaclass=PoolMeta):
 
 class Group(metaclass=PoolMeta):
     __name__ = 'account.payment.group'
+    csb58_state = fields.Selection([
+            (None, ''),
+            ('queued', 'Queued'),
+            ('processing', 'Processing'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'CSB 58 State', readonly=True)
+    csb58_attempts = fields.Integer('CSB 58 Attempts', readonly=True)
+    csb58_message = fields.Text('CSB 58 Message', readonly=True)
+    csb58_fingerprint = fields.Char('CSB 58 Fingerprint', readonly=True,
+        help='Digest of the inputs of the attached CSB 58 file.')
+    csb58_receipts = fields.Function(fields.Integer('CSB 58 Receipts',
+            help='Number of receipts of the CSB 58 file.'),
+        'get_csb58_summary')
+    csb58_amount = fields.Function(fields.Numeric('CSB 58 Amount',
+            digits=(16, 2), help='Total amount of the CSB 58 file.'),
+        'get_csb58_summary')
+    csb58_records = fields.Function(fields.Integer('CSB 58 Records',
+            help='Number of records of the CSB 58 file without domicile.'),
+        'get_csb58_summary')
+    csb58_domicile_records = fields.Function(fields.Integer(
+            'CSB 58 Records with Domicile',
+            help='Number of records of the CSB 58 file with domicile.'),
+        'get_csb58_summary')
 
     @classmethod
     def __setup__(cls):
@@ -170,332 +727,1232 @@ class Group(metaclass=PoolMeta):
                     'The payment "%s" doesn\'t have bank account.'),
                 'party_without_bank_account': (
                     'The party "%s" doesn\'t have bank account.'),
+                'csb58_errors': ('The CSB 58 file of group "%(group)s" can '
+                    'not be built:\n%(errors)s'),
+                'csb58_more_errors': '... and %s more.',
+                'csb58_different_presenter': ('The CSB 58 files of groups '
+                    '"%(first)s" and "%(group)s" can not be consolidated '
+                    'because they have different presenters.'),
+                'csb58_invalid_file': ('The CSB 58 file generated for group '
+                    '"%(group)s" is not valid:\n%(error)s'),
+                'csb58_interrupted': ('The processing of the CSB 58 file was '
+                    'interrupted.'),
+                'csb58_group_locked': ('The CSB 58 file of groups '
+                    '"%(groups)s" can not be generated now because they are '
+                    'being processed by another user.'),
                 })
 
-    def set_default_csb58_payment_values(self):
+    @classmethod
+    def view_attributes(cls):
+        return super(Group, cls).view_attributes() + [
+            ('//group[@id="csb_58"]', 'states', {
+                    'invisible': Eval('process_method') != 'csb58',
+                    })]
+
+    @classmethod
+    def get_csb58_addresses(cls, party_ids):
+        """
+        Return a dictionary with the values of the invoice address of each
+        party id as Party.address_get(type='invoice') would find it but
+        reading all the addresses and subdivisions with a single query
+
+        The rows are read with the regular cursor of the transaction, so at
+        most the addresses of a slice of parties are held at a time.
+        """
+        pool = Pool()
+        Address = pool.get('party.address')
+        Subdivision = pool.get('country.subdivision')
+        address = Address.__table__()
+        subdivision = Subdivision.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {}
+        for sub_ids in grouped_slice(sorted(party_ids)):
+            cursor.execute(*address.join(subdivision, 'LEFT',
+                    condition=address.subdivision == subdivision.id
+                    ).select(address.party, address.street, address.zip,
+                    address.city, address.country, address.invoice,
+                    subdivision.code, subdivision.type,
+                    where=reduce_ids(address.party, sub_ids)
+                    & (address.active == Literal(True)),
+                    # Without sequence first, as Address.order_sequence
+                    order_by=[address.party,
+                        Case((address.sequence == Null, 0), else_=1),
+                        address.sequence.asc, address.id.asc]))
+            for (party_id, street, zip_, city, country, invoice,
+                    subdivision_code, subdivision_type) in cursor:
+                # The first address is the default one unless a later
+                # address is flagged as invoice address
+                if party_id in result and (not invoice
+                        or result[party_id]['invoice']):
+                    continue
+                result[party_id] = {
+                    'street': street,
+                    'zip': zip_,
+                    'city': city,
+                    'country': country,
+                    'invoice': invoice,
+                    'province': province[subdivision_code
+                        if subdivision_type == 'province' else 'none'],
+                    }
+        return result
+
+    @classmethod
+    def get_csb58_payment_rows(cls, payment_ids):
+        """
+        Yield a Csb58PaymentRow with the values of each payment id, its party
+        and its move line, in ascending id order, with a single query for
+        each slice of ids
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Party = pool.get('party.party')
+        Line = pool.get('account.move.line')
+        payment = Payment.__table__()
+        party = Party.__table__()
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+
+        for sub_ids in grouped_slice(sorted(payment_ids)):
+            cursor.execute(*payment.join(party,
+                    condition=payment.party == party.id
+                    ).join(line, 'LEFT', condition=payment.line == line.id
+                    ).select(payment.id, payment.party, payment.bank_account,
+                    payment.amount, payment.description, payment.create_date,
+                    payment.csb58_record, payment.csb58_record_date,
+                    party.name, party.code, line.maturity_date,
+                    where=reduce_ids(payment.id, sub_ids),
+                    order_by=payment.id.asc))
+            for row in cursor:
+                yield Csb58PaymentRow._make(row)
+
+    def set_default_csb58_payment_values(self, stats=None, payment_ids=None,
+            use_cache=True, errors=None):
+        '''
+        Return the values of the CSB 58 file of the group.
+
+        The duration of its phases and the bank code validations are recorded
+        in stats, a Csb58Stats, if it is given.
+
+        Only the payments of payment_ids are included if it is given. In
+        incremental journals the records cached on the payments are used as
+        receipts unless use_cache is False.
+
+        All the errors found are added to errors, a Csb58Errors, if it is
+        given and the values are returned anyway, otherwise a single user
+        error with all of them is raised.
+        '''
         pool = Pool()
         Party = pool.get('party.party')
+        BankAccount = pool.get('bank.account')
+        Payment = pool.get('account.payment')
         Date = pool.get('ir.date')
         today = Date.today()
-        values = {}
+        if stats is None:
+            stats = Csb58Stats()
+        raise_errors = errors is None
+        if raise_errors:
+            errors = Csb58Errors()
+        bank_codes = check_bank_code.cache_info()
         journal = self.journal
-        values['payment_journal'] = journal
-        values['party'] = journal.party
-        values['name'] = values['party'].name
-
-        # Checks bank account code.
-        bank_account = journal.sepa_bank_account_number.account
-        if not bank_account:
-            self.raise_user_error('configuration_error',
-                error_description='bank_account_not_defined',
-                error_description_args=(values['name']))
-        code = bank_account.get_first_other_number()
-        if not code or not banknumber.check_code('ES', code):
-            self.raise_user_error('configuration_error',
-                        error_description='wrong_bank_account',
-                        error_description_args=(values['name'],))
-
-        # Checks vat number
-        vat = journal.party and journal.party.vat_number \
-            or False
-        if not vat:
-            self.raise_user_error('configuration_error',
-                        error_description='vat_number_not_defined',
-                        error_description_args=(values['name']))
+        values, journal_errors = journal.get_csb58_header_values()
+        for error in journal_errors:
+            errors.add(*error)
 
         # Checks whether exists lines
-        payments = self.payments
-        if not payments:
-            self.raise_user_error('no_lines')
+        if payment_ids is None:
+            if not self.payments:
+                errors.add('no_lines', self.__name__, self.id, self.rec_name)
+            payment_ids = [p.id for p in self.payments]
 
         values['number'] = str(self.id)
         values['payment_date'] = self.planned_date if self.planned_date \
             else today
         values['creation_date'] = today
-        values['vat_number'] = vat
-        values['suffix'] = journal.suffix
-        values['company_name'] = journal.company.party.name
-        values['bank_account'] = code
-        values['ine_code'] = journal.ine_code
         values['amount'] = 0
 
-        values['address'] = Party.address_get(values['party'], type='invoice')
-        if values['address']:
-            values['street'] = values['address'].street
-            values['zip'] = values['address'].zip
-            values['city'] = values['address'].city
-            values['subdivision'] = values['address'].subdivision or False
-            values['province'] = province[values['subdivision'].code
-                    if (values['subdivision']
-                        and values['subdivision'].type == 'province')
-                    else 'none']
+        use_cache &= bool(journal.csb58_incremental and not self.join)
+        records = 2 if values['include_domicile'] else 1
 
-        receipts = []
-        if self.join:
-            parties_bank_accounts = {}
-            # Join all receipts of the same party and bank_account
-            for payment in payments:
-                key = (payment.party, payment.bank_account)
-                if key not in parties_bank_accounts:
-                    parties_bank_accounts[key] = [payment]
-                else:
-                    parties_bank_accounts[key].append(payment)
-            for party_bank_account in parties_bank_accounts:
-                if not party_bank_account or not party_bank_account[1]:
-                    self.raise_user_error('party_without_bank_account',
-                        party_bank_account and party_bank_account[0]
-                            and party_bank_account[0].rec_name)
-                amount = 0
-                communication = ''
-                date = False
-                maturity_date = today
-                create_date = False
-                date_created = False
-                invoices = []
-                for payment in parties_bank_accounts[party_bank_account]:
-                    amount += payment.amount
-                    communication += '%s %s' % (payment.id,
-                        payment.description)
-                    if not date or date < payment.date:
-                        date = payment.date
-                    if payment.line:
-                        if (not maturity_date
-                                or maturity_date < payment.line.maturity_date):
-                            maturity_date = payment.line.maturity_date
-                        invoices.append(payment.line.origin)
-                    if not create_date or create_date < payment.create_date:
-                        create_date = payment.create_date
-                    if not date_created or date_created < payment.date:
-                        date_created = payment.date
-
-                vals = {
-                    'party': party_bank_account[0],
-                    'bank_account':
-                        party_bank_account[1].get_first_other_number(),
-                    'invoices': invoices,
-                    'amount': amount,
-                    'communication': communication,
-                    'date': date,
-                    'maturity_date': maturity_date,
-                    'create_date': create_date,
-                    'date_created': date_created,
-                    'vat_number': party_bank_account[0].vat_number,
-                    }
-                address = Party.address_get(party_bank_account[0],
-                    type='invoice')
-                if address:
-                    vals['name'] = vals['party'].name
-                    vals['address'] = address
-                    vals['street'] = address.street or False
-                    vals['streetbis'] = address.streetbis or False
-                    vals['zip'] = address.zip or False
-                    vals['city'] = address.city or False
-                    vals['country'] = address.country or False
-                    if vals['country']:
-                        vals['country_code'] = (vals['country'].code
-                            or False)
-                    vals['subdivision'] = address.subdivision or False
-                    vals['state'] = (vals['subdivision']
-                            and vals['subdivision'].name or '')
-                    vals['province'] = province[vals['subdivision'].code
-                            if (vals['subdivision']
-                                and vals['subdivision'].type == 'province')
-                            else 'none']
-                receipts.append(vals)
-                values['amount'] += abs(amount)
-        else:
-            # Each payment is a receipt
-            for payment in payments:
-                if not payment.bank_account:
-                    self.raise_user_error('payment_without_bank_account',
-                        payment.rec_name)
-                party = payment.party
-                amount = payment.amount
-                vals = {
-                    'party': party,
-                    'bank_account':
-                        payment.bank_account.get_first_other_number(),
-                    'invoices': [payment.line and payment.line.origin or None],
-                    'amount': amount,
-                    'communication': '%s %s' % (payment.id,
-                        payment.description),
-                    'date': payment.date,
-                    'maturity_date': (payment.line
-                        and payment.line.maturity_date or today),
-                    'create_date': payment.create_date,
-                    'date_created': payment.date,
-                    'vat_number': party.vat_number,
-                    }
-                address = Party.address_get(party, type='invoice')
-                if address:
-                    vals['name'] = vals['party'].name
-                    vals['address'] = address
-                    vals['street'] = address.street or False
-                    vals['streetbis'] = address.streetbis or False
-                    vals['zip'] = address.zip or False
-                    vals['city'] = address.city or False
-                    vals['country'] = address.country or False
-                    if vals['country']:
-                        vals['country_code'] = vals['country'].code or False
-                    vals['subdivision'] = address.subdivision or False
-                    if vals['subdivision']:
-                        vals['state'] = vals['subdivision'].name or ''
-                    vals['province'] = province[vals['subdivision'].code
-                            if (vals['subdivision']
-                                and vals['subdivision'].type == 'province')
-                            else 'none']
-                receipts.append(vals)
-                values['amount'] += abs(amount)
-        if journal.require_bank_account:
-            for receipt in receipts:
-                if not receipt['bank_account']:
-                    self.raise_user_error('configuration_error',
-                        error_description='customer_bank_account_not_defined',
-                        error_description_args=(receipt['name'],))
-                if not banknumber.check_code('ES', receipt['bank_account']):
-                    self.raise_user_error('configuration_error',
-                        error_description='wrong_party_bank_account',
-                        error_description_args=(receipt['name'],))
+        # Load everything the receipts need with a constant number of
+        # queries instead of dereferencing it payment by payment
+        with stats.phase('read'):
+            payments = list(self.get_csb58_payment_rows(payment_ids))
+            cached = {}
+            if use_cache:
+                for payment in payments:
+                    record = payment.csb58_record
+                    if (record and (not payment.csb58_record_date
+                                or payment.csb58_record_date == today)):
+                        record = tuple(record.split(csb58.SEPARATOR))
+                        if len(record) == records:
+                            cached[payment.id] = record
+            addresses = self.get_csb58_addresses({p.party for p in payments
+                    if p.id not in cached})
+            bank_numbers = BankAccount.get_first_other_numbers(
+                list({p.bank_account for p in payments
+                        if p.bank_account and p.id not in cached}))
+
+        def get_receipt(payment, bank_account, **vals):
+            address = addresses.get(payment.party)
+            if not self.check_csb58_payment(payment.party, payment.party_name,
+                    bank_account, address, errors):
+                return
+            return csb58.Receipt(
+                payment=payment.id,
+                reference=payment.party_code,
+                name=payment.party_name,
+                bank_account=bank_account,
+                street=address['street'],
+                city=address['city'],
+                zip=address['zip'],
+                province=address['province'],
+                **vals)
+
+        with stats.phase('receipts'):
+            receipts = []
+            if self.join:
+                # Join all receipts of the same party and bank account in a
+                # single pass keyed by their ids. The receipts keep the order
+                # in which each key first appears.
+                joined = {}
+                for payment in payments:
+                    if not payment.bank_account:
+                        errors.add('party_without_bank_account',
+                            Party.__name__, payment.party, payment.party_name)
+                        continue
+                    maturity_date = today
+                    if (payment.maturity_date
+                            and maturity_date < payment.maturity_date):
+                        maturity_date = payment.maturity_date
+                    key = (payment.party, payment.bank_account)
+                    receipt = joined.get(key)
+                    if receipt is None:
+                        joined[key] = [payment, payment.amount,
+                            ['%s %s' % (payment.id, payment.description)],
+                            maturity_date, payment.create_date]
+                        continue
+                    receipt[1] += payment.amount
+                    receipt[2].append('%s %s' % (payment.id,
+                            payment.description))
+                    if receipt[3] < maturity_date:
+                        receipt[3] = maturity_date
+                    if receipt[4] < payment.create_date:
+                        receipt[4] = payment.create_date
+                for (_, bank_account_id), receipt in joined.items():
+                    payment, amount, concepts, maturity_date, create_date = \
+                        receipt
+                    receipt = get_receipt(payment,
+                        bank_numbers[bank_account_id],
+                        amount=amount,
+                        concept=''.join(concepts),
+                        due_date=maturity_date,
+                        origin_date=create_date)
+                    if receipt:
+                        receipts.append(receipt)
+                        values['amount'] += abs(amount)
+            else:
+                # Each payment is a receipt
+                for payment in payments:
+                    if payment.id in cached:
+                        receipts.append(csb58.Receipt(
+                                payment=payment.id,
+                                amount=payment.amount,
+                                records=cached[payment.id]))
+                        values['amount'] += abs(payment.amount)
+                        continue
+                    if not payment.bank_account:
+                        errors.add('payment_without_bank_account',
+                            Payment.__name__, payment.id,
+                            Payment(payment.id).rec_name)
+                        continue
+                    receipt = get_receipt(payment,
+                        bank_numbers[payment.bank_account],
+                        amount=payment.amount,
+                        concept='%s %s' % (payment.id, payment.description),
+                        due_date=payment.maturity_date or today,
+                        origin_date=payment.create_date)
+                    if receipt:
+                        receipts.append(receipt)
+                        values['amount'] += abs(payment.amount)
+
+        cache_info = check_bank_code.cache_info()
+        stats.counters['receipts'] = len(receipts)
+        stats.counters['cached_receipts'] = len(cached)
+        stats.counters['bank_code_hits'] = cache_info.hits - bank_codes.hits
+        stats.counters['bank_code_misses'] = (cache_info.misses
+            - bank_codes.misses)
         values['receipts'] = receipts
-        values['include_domicile'] = values['payment_journal'].\
-            csb58_include_domicile
-        values['record_count'] = 0
-        values['ordering_records'] = 0
-        values['ordering_record_count'] = 0
-        for receipt in values['receipts']:
-            receipt['reference'] = receipt['party'].code
-            if not receipt['address']:
-                self.raise_user_error('configuration_error',
-                    error_description='party_without_address',
-                    error_description_args=(receipt['party'].name,))
-            if not receipt['zip'] or not receipt['city'] or \
-                    not receipt['country']:
-                self.raise_user_error('configuration_error',
-                    error_description='party_without_complete_address',
-                    error_description_args=(receipt['party'].name,))
+        if raise_errors and errors:
+            self.raise_user_error('csb58_errors', {
+                    'group': self.rec_name,
+                    'errors': errors.get_message(self),
+                    })
         return values
 
-    def attach_file(self, data):
+    @classmethod
+    def get_csb58_summary(cls, groups, names):
+        '''
+        Return the number of receipts, the amount and the number of records
+        with and without domicile of the CSB 58 files of the groups without
+        building them.
+
+        The receipts are counted and added with two aggregated queries for
+        each slice of groups, one for the groups that join their payments
+        by party and bank account and one for the rest. Payments without
+        bank account are left out as they can not be written. Groups of
+        other process methods have no summary.
+        '''
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        payment = Payment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        groups = [g for g in groups if g.journal.process_method == 'csb58']
+        summaries = dict((g.id, (0, Decimal(0))) for g in groups)
+        for join in (False, True):
+            group_ids = [g.id for g in groups if bool(g.join) == join]
+            for sub_ids in grouped_slice(group_ids):
+                where = (reduce_ids(payment.group, sub_ids)
+                    & (payment.bank_account != Null))
+                if join:
+                    receipt = payment.select(payment.group,
+                        Sum(payment.amount).as_('amount'),
+                        where=where,
+                        group_by=[payment.group, payment.party,
+                            payment.bank_account])
+                    query = receipt.select(receipt.group,
+                        Count(Literal('*')), Sum(Abs(receipt.amount)),
+                        group_by=receipt.group)
+                else:
+                    query = payment.select(payment.group,
+                        Count(Literal('*')), Sum(Abs(payment.amount)),
+                        where=where,
+                        group_by=payment.group)
+                cursor.execute(*query)
+                for group_id, receipts, amount in cursor.fetchall():
+                    # SQLite does not keep the type of the aggregated amounts
+                    if not isinstance(amount, Decimal):
+                        amount = Decimal(str(amount))
+                    summaries[group_id] = (receipts, amount)
+
+        result = dict((n, {}) for n in names)
+        for group in groups:
+            receipts, amount = summaries[group.id]
+            journal = group.journal
+            size = journal.csb58_chunk_size
+            mode = journal.csb58_chunk_mode
+            for name, include_domicile in (('csb58_records', False),
+                    ('csb58_domicile_records', True)):
+                if name not in result:
+                    continue
+                if size and mode == 'file':
+                    # Each chunk is written as a file of a single block
+                    full, rest = divmod(receipts, size)
+                    records = full * csb58.count_records(size,
+                        include_domicile)
+                    if rest or not full:
+                        records += csb58.count_records(rest,
+                            include_domicile)
+                else:
+                    records = csb58.count_records(receipts, include_domicile,
+                        size if mode == 'block' else None)
+                result[name][group.id] = records
+            if 'csb58_receipts' in result:
+                result['csb58_receipts'][group.id] = receipts
+            if 'csb58_amount' in result:
+                result['csb58_amount'][group.id] = amount
+        return result
+
+    def check_csb58_payment(self, party_id, party_name, bank_account,
+            address, errors):
+        '''
+        Add to errors the problems that prevent writing a receipt of the
+        party with the bank account code and the values of its address, as
+        returned by get_csb58_addresses, and return whether it can be
+        written.
+        '''
+        Party = Pool().get('party.party')
+        journal = self.journal
+        party = (Party.__name__, party_id, party_name)
+        valid = True
+        if journal.require_bank_account:
+            if not bank_account:
+                errors.add('customer_bank_account_not_defined', *party)
+                valid = False
+            elif not check_bank_code(bank_account):
+                errors.add('wrong_party_bank_account', *party)
+                valid = False
+        if not address:
+            errors.add('party_without_address', *party)
+            return False
+        if (not address['zip'] or not address['city']
+                or not address['country']):
+            errors.add('party_without_complete_address', *party)
+            return False
+        # The address records are sent to the bank with the province
+        if journal.csb58_include_domicile and not address['province']:
+            errors.add('party_without_province', *party)
+            return False
+        return valid
+
+    def get_csb58_errors(self):
+        '''
+        Return a Csb58Errors with all the errors that prevent building the
+        CSB 58 file of the group without building it.
+
+        Only the party and bank account of the payments are read, with a
+        single query, and their addresses and bank account codes with a
+        query for each slice of them, so it is cheap enough to check a group
+        before it is processed.
+        '''
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Party = pool.get('party.party')
+        BankAccount = pool.get('bank.account')
+        payment = Payment.__table__()
+        party = Party.__table__()
+        cursor = Transaction().connection.cursor()
+
+        errors = Csb58Errors()
+        for error in self.journal.get_csb58_header_values()[1]:
+            errors.add(*error)
+        cursor.execute(*payment.join(party,
+                condition=payment.party == party.id
+                ).select(payment.id, payment.party, payment.bank_account,
+                party.name,
+                where=payment.group == self.id,
+                order_by=payment.id.asc))
+        rows = cursor.fetchall()
+        if not rows:
+            errors.add('no_lines', self.__name__, self.id, self.rec_name)
+        addresses = self.get_csb58_addresses({r[1] for r in rows})
+        bank_numbers = BankAccount.get_first_other_numbers(
+            list({r[2] for r in rows if r[2]}))
+        without_bank_account = []
+        for payment_id, party_id, bank_account_id, party_name in rows:
+            if not bank_account_id:
+                if self.join:
+                    errors.add('party_without_bank_account', Party.__name__,
+                        party_id, party_name)
+                else:
+                    without_bank_account.append(payment_id)
+                continue
+            self.check_csb58_payment(party_id, party_name,
+                bank_numbers[bank_account_id], addresses.get(party_id),
+                errors)
+        # Read the names of all the payments at once
+        for record in Payment.browse(without_bank_account):
+            errors.add('payment_without_bank_account', Payment.__name__,
+                record.id, record.rec_name)
+        return errors
+
+    def get_csb58_fingerprint(self):
+        """
+        Return a digest of everything the CSB 58 file of the group depends
+        on: the date, the group and journal settings, the presenter and
+        company parties, the values of the payments and their move lines and
+        the last change of their parties, addresses, the subdivisions the
+        provinces come from and bank numbers.
+
+        It only reads a few columns of each table so it is much cheaper than
+        building the file.
+        """
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        Party = pool.get('party.party')
+        Line = pool.get('account.move.line')
+        Address = pool.get('party.address')
+        Number = pool.get('bank.account.number')
+        Subdivision = pool.get('country.subdivision')
+        Date = pool.get('ir.date')
+        payment = Payment.__table__()
+        party = Party.__table__()
+        line = Line.__table__()
+        address = Address.__table__()
+        number = Number.__table__()
+        subdivision = Subdivision.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def modified(table):
+            return Coalesce(table.write_date, table.create_date)
+
+        def subdivision_key(subdivision):
+            if subdivision:
+                return (subdivision.id, subdivision.code, subdivision.type,
+                    subdivision.write_date)
+
+        journal = self.journal
+        presenter = journal.party
+        # The name of the headers is the one of the company party
+        company = journal.company.party
+        digest = hashlib.sha256()
+        digest.update(repr((Date.today(), self.id, self.join,
+                    self.planned_date, journal.id, journal.write_date,
+                    presenter.id, presenter.write_date,
+                    [(a.id, a.write_date, subdivision_key(a.subdivision))
+                        for a in presenter.addresses],
+                    company.id, company.write_date,
+                    journal.sepa_bank_account_number.id,
+                    journal.sepa_bank_account_number.write_date,
+                    )).encode('utf-8'))
+
+        group_payments = payment.select(payment.party,
+            where=payment.group == self.id)
+        group_accounts = payment.select(payment.bank_account,
+            where=payment.group == self.id)
+        queries = [
+            payment.join(party, condition=payment.party == party.id
+                ).join(line, 'LEFT', condition=payment.line == line.id
+                ).select(payment.id, payment.amount, payment.description,
+                payment.bank_account, payment.create_date, party.id,
+                modified(party), line.maturity_date,
+                where=payment.group == self.id,
+                order_by=payment.id.asc),
+            address.join(subdivision, 'LEFT',
+                condition=address.subdivision == subdivision.id
+                ).select(address.party, address.id, modified(address),
+                subdivision.id, subdivision.code, subdivision.type,
+                where=address.party.in_(group_payments),
+                order_by=[address.party.asc, address.id.asc]),
+            number.select(number.account, Count(number.id),
+                Max(modified(number)),
+                where=number.account.in_(group_accounts),
+                group_by=number.account, order_by=number.account.asc),
+            ]
+        for query in queries:
+            cursor.execute(*query)
+            for row in cursor:
+                digest.update(repr(row).encode('utf-8'))
+        return digest.hexdigest()
+
+    @classmethod
+    def get_csb58_attachments(cls, groups):
+        'Return a dictionary with the CSB 58 attachments of each group'
         IrAttachment = Pool().get('ir.attachment')
+        remittance = cls.raise_user_error('remittance', raise_exception=False)
+        groups = dict((str(g), g) for g in groups)
+        result = dict((g, []) for g in groups.values())
+        for sub_resources in grouped_slice(list(groups)):
+            for attachment in IrAttachment.search([
+                        ('resource', 'in', list(sub_resources)),
+                        ]):
+                group = groups[str(attachment.resource)]
+                name = group.get_attachment_values(None,
+                    remittance)['name']
+                if (attachment.name == name
+                        or attachment.name.startswith(name + '_')):
+                    result[group].append(attachment)
+        return result
+
+    def get_attachment_values(self, data, remittance=None, stats=None,
+            part=None):
+        if remittance is None:
+            remittance = self.raise_user_error('remittance',
+                raise_exception=False)
         journal = self.journal
+        name = '%s_%s_%s' % (remittance, journal.process_method,
+            self.reference)
+        if part is not None:
+            name += '_%s' % part
         values = {
-            'name': '%s_%s_%s' % (
-                self.raise_user_error('remittance', raise_exception=False),
-                journal.process_method, self.reference),
+            'name': name,
             'type': 'data',
             'data': data,
             'resource': '%s' % (self),
             }
-        IrAttachment.create([values])
+        if stats is not None:
+            values['description'] = str(stats)
+        return values
+
+    def attach_file(self, data):
+        self.attach_files([(self, data)])
+
+    @classmethod
+    def attach_files(cls, groups_data, stats=None):
+        """
+        Attach each (group, data) pair with a single create
+
+        stats is an optional dictionary with the Csb58Stats of each group id
+        which are stored as description of its attachment. The attachments of
+        groups with many files are numbered in the order they are given.
+        """
+        IrAttachment = Pool().get('ir.attachment')
+        remittance = cls.raise_user_error('remittance', raise_exception=False)
+        stats = stats or {}
+        groups_data = list(groups_data)
+        files = Counter(g for g, _ in groups_data)
+        parts = Counter()
+        vlist = []
+        for group, data in groups_data:
+            part = None
+            if files[group] > 1:
+                parts[group] += 1
+                part = parts[group]
+            vlist.append(group.get_attachment_values(data, remittance,
+                    stats.get(group.id), part))
+        IrAttachment.create(vlist)
+
+    @classmethod
+    def attach_paths(cls, groups_paths, stats=None):
+        '''
+        Attach the content of the file of each (group, path) pair
+
+        Each file is read once even if it is given for many groups, like the
+        consolidated file, so all its attachments share the same bytes.
+        '''
+        contents = {}
+        groups_data = []
+        for group, path in groups_paths:
+            if path not in contents:
+                with open(path, 'rb') as file_:
+                    contents[path] = file_.read()
+            groups_data.append((group, contents[path]))
+        cls.attach_files(groups_data, stats=stats)
+
+    @classmethod
+    def validate_csb58_path(cls, group, path, stats):
+        '''
+        Check the generated CSB 58 file at path of group is internally
+        consistent unless the "validate" option of the
+        account_payment_es_csb_58 section of the configuration is False.
+
+        The time it takes is added to stats.
+        '''
+        if not config.getboolean('account_payment_es_csb_58', 'validate',
+                default=True):
+            return
+        start = time.perf_counter()
+        try:
+            csb58.validate_file(path)
+        except csb58.InvalidFile as e:
+            cls.raise_user_error('csb58_invalid_file', {
+                    'group': group.rec_name,
+                    'error': str(e),
+                    })
+        finally:
+            stats.add_duration('validate', time.perf_counter() - start)
+
+    @classmethod
+    def lock_csb58(cls, groups):
+        '''
+        Lock the rows of groups until the end of the transaction so a group
+        is never processed twice at once.
+
+        The locks are not waited for: if another transaction is processing
+        or has modified any of the groups a user error is raised at once.
+        Only the rows of groups are locked so other groups, even of the same
+        journal, are processed concurrently. Backends without SELECT FOR
+        UPDATE, like SQLite, already serialize the transactions that write.
+        '''
+        transaction = Transaction()
+        if not groups or not transaction.database.has_select_for():
+            return
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        table = cls.__table__()
+        cursor = transaction.connection.cursor()
+        # Once the lock has failed the transaction is aborted so neither the
+        # names nor the translation of the error can be read anymore
+        names = ', '.join(g.rec_name for g in groups)
+        message = cls.raise_user_error('csb58_group_locked', {
+                'groups': names,
+                }, raise_exception=False)
+        try:
+            # In the same order in all the transactions to avoid deadlocks
+            for sub_ids in grouped_slice(sorted(g.id for g in groups)):
+                cursor.execute(*table.select(table.id,
+                        where=reduce_ids(table.id, sub_ids),
+                        for_=For('UPDATE', nowait=True)))
+        except DatabaseOperationalError:
+            logger.debug('CSB 58 groups %s are locked', names, exc_info=True)
+            raise UserError(message)
 
     @classmethod
     def process_csb58(cls, group):
-        def set_presenter_header_record():
-            record = Record(c58.PRESENTER_HEADER_RECORD)
-            record.record_code = '51'
-            record.data_code = '70'
-            record.nif = values['vat_code']
-            record.suffix = values['suffix']
-            record.creation_date = values['creation_date']
-            record.name = values['company_name']
-            record.bank_code = str(values['bank_account'][0:4])
-            record.bank_office = str(values['bank_account'][4:8])
-            return retrofix_write([record])
-
-        def set_ordering_header_record():
-            record = Record(c58.ORDERING_HEADER_RECORD)
-            record.record_code = '53'
-            record.data_code = '70'
-            record.nif = values['vat_code']
-            record.suffix = values['suffix']
-            record.creation_date = values['creation_date']
-            record.name = values['company_name']
-            record.account = values['bank_account']
-            record.procedure = '06'
-            record.ine = values['ine_code'].zfill(9)
-            return retrofix_write([record])
-
-        def set_required_individual_record():
-            record = Record(c58.REQUIRED_INDIVIDUAL_RECORD)
-            record.record_code = '56'
-            record.data_code = '70'
-            record.nif = values['vat_code']
-            record.suffix = values['suffix']
-            record.reference = receipt['reference']
-            record.name = receipt['name']
-            record.account = receipt['bank_account']
-            record.amount = receipt['amount']
-            record.return_code = ''
-            record.internal_code = ''
-            record.concept = receipt['communication']
-            record.due_date = receipt['maturity_date']
-            return retrofix_write([record])
-
-        def set_optional_individual_record():
-            record = Record(c58.OPTIONAL_INDIVIDUAL_RECORD)
-            record.record_code = '56'
-            record.data_code = '71'
-            record.nif = values['vat_code']
-            record.suffix = values['suffix']
-            record.reference = receipt['reference']
-            record.concept_2 = ''
-            record.concept_3 = ''
-            record.concept_4 = ''
-            return retrofix_write([record])
-
-        def set_address_individual_record():
-            record = Record(c58.ADDRESS_INDIVIDUAL_RECORD)
-            record.record_code = '56'
-            record.data_code = '76'
-            record.nif = values['vat_code']
-            record.suffix = values['suffix']
-            record.reference = receipt['reference']
-            record.payer_address = receipt['street']
-            record.payer_city = receipt['city']
-            record.payer_zip = receipt['zip']
-            record.ordering_city = values['city']
-            record.province_code = values['province']
-            record.origin_date = receipt['create_date']
-            return retrofix_write([record])
-
-        def set_ordering_footer_record():
-            record = Record(c58.ORDERING_FOOTER_RECORD)
-            record.record_code = '58'
-            record.data_code = '70'
-            record.nif = values['vat_code']
-            record.suffix = values['suffix']
-            record.amount = values['amount']
-            record.payment_line_count = str(values['ordering_records'])
-            record.record_count = str(values['ordering_record_count'])
-            return retrofix_write([record])
-
-        def set_presenter_footer_record():
-            record = Record(c58.PRESENTER_FOOTER_RECORD)
-            record.record_code = '59'
-            record.data_code = '70'
-            record.nif = values['vat_code']
-            record.suffix = values['suffix']
-            record.ordering_count = '0001'
-            record.amount = values['amount']
-            record.payment_line_count = str(values['ordering_records'])
-            record.record_count = str(values['record_count'])
-            return retrofix_write([record])
-
-        values = Group.set_default_csb58_payment_values(group)
-        text = set_presenter_header_record()
-        values['record_count'] += 1
-        text += set_ordering_header_record()
-        values['record_count'] += 1
-        for receipt in values['receipts']:
-            text += set_required_individual_record()
-            values['record_count'] += 1
-            values['ordering_records'] += 1
-            if values['include_domicile']:
-                text += set_address_individual_record()
-                values['record_count'] += 1
-                values['ordering_records'] += 1
-        values['ordering_record_count'] = values['ordering_records'] + 2
-        text += set_ordering_footer_record()
-        values['record_count'] += 2
-        text += set_presenter_footer_record()
-        group.attach_file(text)
+        if group.journal.csb58_background:
+            # Report all the errors now instead of when the queue runs
+            errors = group.get_csb58_errors()
+            if errors:
+                cls.raise_user_error('csb58_errors', {
+                        'group': group.rec_name,
+                        'errors': errors.get_message(group),
+                        })
+            cls.write([group], {
+                    'csb58_state': 'queued',
+                    'csb58_attempts': 0,
+                    'csb58_message': None,
+                    })
+            return
+        cls.process_csb58_groups([group])
+
+    @classmethod
+    def process_csb58_groups(cls, groups):
+        """
+        Generate and attach the CSB 58 files of many groups.
+
+        The values of all the groups are built in the current transaction and
+        the files, which only depend on those values, are rendered one after
+        the other in the current process.
+
+        Rendering in a pool of processes is an explicit opt-in: set the
+        "processes" option of the account_payment_es_csb_58 section of the
+        configuration to more than 1 (it is 1 by default). The workers are
+        spawned, as forking the server would share its database connections
+        and threads with them, so each one re-runs the __main__ module of the
+        server as __mp_main__ and imports this module to unpickle the render
+        function. Only enable it when the entry point of the process that
+        generates the files guards its startup with
+        "if __name__ == '__main__'", otherwise every worker starts a server.
+
+        Each file is encoded line by line into a temporary file so neither the
+        workers nor the server hold it as a string. The receipts of journals
+        that split them in files are rendered into one file per chunk. When
+        rendering in the current process the values of each group are built
+        right before its files are rendered, so only the receipts of one
+        group are held at a time; the pool needs the values of all the files
+        before it starts.
+
+        The Csb58Stats of each group are stored as description of its
+        attachment and logged at the level of the "log_level" option of the
+        same section (INFO by default).
+
+        Groups whose fingerprint has not changed since their attached file
+        was generated keep it, the rest replace their previous files once
+        they are validated by validate_csb58_path.
+
+        The groups are locked by lock_csb58 before anything is read, so a
+        group that is being processed by another transaction fails at once.
+        """
+        IrAttachment = Pool().get('ir.attachment')
+        cls.lock_csb58(groups)
+        stats = dict((g.id, Csb58Stats()) for g in groups)
+        attachments = cls.get_csb58_attachments(groups)
+        fingerprints = {}
+        for group in groups:
+            with stats[group.id].phase('fingerprint'):
+                fingerprint = group.get_csb58_fingerprint()
+            if (fingerprint == group.csb58_fingerprint
+                    and attachments[group]):
+                stats[group.id].counters['reused'] = len(attachments[group])
+            else:
+                fingerprints[group] = fingerprint
+
+        def iter_files():
+            # The values of each group are built when its first file is
+            # rendered and dropped once its last one is
+            for group in fingerprints:
+                with stats[group.id].phase('values'):
+                    values = group.set_default_csb58_payment_values(
+                        stats=stats[group.id])
+                journal = group.journal
+                if (journal.csb58_chunk_size
+                        and journal.csb58_chunk_mode == 'file'):
+                    for chunk in csb58.split(values,
+                            journal.csb58_chunk_size):
+                        yield group, chunk
+                else:
+                    yield group, values
+                del values
+
+        processes = config.getint('account_payment_es_csb_58', 'processes',
+            default=1)
+        # Path, blocks and records of each rendered file
+        rendered = []
+        paths = []
+
+        def add_file(group, values, path, duration):
+            paths.append(path)
+            stats[group.id].add_duration('render', duration)
+            rendered.append((group, path, csb58.block_count(values),
+                    csb58.record_count(values)))
+        try:
+            if processes > 1:
+                # Only the servers that opt in to render in parallel load
+                # them
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # The pool submits the values of all the files at once
+                files = list(iter_files())
+                with ProcessPoolExecutor(
+                        max_workers=max(min(processes, len(files)), 1),
+                        mp_context=multiprocessing.get_context('spawn')
+                        ) as executor:
+                    results = executor.map(csb58.timed_render_to_file,
+                        [v for _, v in files])
+                    for (group, values), (path, duration) in zip(files,
+                            results):
+                        add_file(group, values, path, duration)
+                del files
+            else:
+                for group, values in iter_files():
+                    path, duration = csb58.timed_render_to_file(values)
+                    add_file(group, values, path, duration)
+            for group, path, blocks, records in rendered:
+                cls.validate_csb58_path(group, path, stats[group.id])
+                counters = stats[group.id].counters
+                counters['files'] = counters.get('files', 0) + 1
+                counters['blocks'] = counters.get('blocks', 0) + blocks
+                counters['records'] = counters.get('records', 0) + records
+                counters['bytes'] = (counters.get('bytes', 0)
+                    + os.path.getsize(path))
+            groups_paths = [(g, p) for g, p, _, _ in rendered]
+            start = time.perf_counter()
+            IrAttachment.delete(sum((attachments[g] for g in fingerprints),
+                    []))
+            cls.attach_paths(groups_paths, stats=stats)
+            to_write = []
+            for group, fingerprint in fingerprints.items():
+                to_write.extend([[group], {
+                            'csb58_fingerprint': fingerprint,
+                            }])
+            if to_write:
+                cls.write(*to_write)
+            duration = time.perf_counter() - start
+        finally:
+            for path in paths:
+                os.remove(path)
+        level = getattr(logging, config.get('account_payment_es_csb_58',
+                'log_level', default='INFO').upper(), logging.INFO)
+        if logger.isEnabledFor(level):
+            for group in groups:
+                # The attachments of all the groups are created at once
+                logger.log(level, 'CSB 58 file of group %s: %s attach=%.3fs',
+                    group.id, stats[group.id], duration)
+        return stats
+
+    @classmethod
+    def process_csb58_consolidated(cls, groups):
+        """
+        Generate a single CSB 58 file with an ordering block for each group
+        and attach it to all of them.
+
+        The groups may belong to different journals, for example with
+        different suffixes, but they must share the presenter of the first
+        one. The file is written as the values of each group are built and
+        the totals of its presenter footer are accumulated along the blocks,
+        so only the values of one group are held at a time. Journals that
+        split their receipts in files are written as a single file.
+
+        The file replaces the previous CSB 58 attachments of the groups and
+        their fingerprints are cleared as it does not match any of them. The
+        groups are locked by lock_csb58 as in process_csb58_groups.
+        """
+        IrAttachment = Pool().get('ir.attachment')
+        if not groups:
+            return {}
+        cls.lock_csb58(groups)
+        for group in groups:
+            if group.journal.process_method != 'csb58':
+                cls.raise_user_error('wrong_payment_journal')
+        stats = dict((g.id, Csb58Stats()) for g in groups)
+        first = groups[0]
+        presenter = first.journal.get_csb58_header_values()[0]['vat_code']
+
+        def iter_values():
+            for group in groups:
+                with stats[group.id].phase('values'):
+                    values = group.set_default_csb58_payment_values(
+                        stats=stats[group.id])
+                if values['vat_code'] != presenter:
+                    cls.raise_user_error('csb58_different_presenter', {
+                            'first': first.rec_name,
+                            'group': group.rec_name,
+                            })
+                counters = stats[group.id].counters
+                counters['blocks'] = csb58.block_count(values)
+                counters['records'] = csb58.record_count(values)
+                yield values
+
+        start = time.perf_counter()
+        path = csb58.render_consolidated_to_file(iter_values())
+        try:
+            duration = time.perf_counter() - start
+            cls.validate_csb58_path(first, path, stats[first.id])
+            size = os.path.getsize(path)
+            for group in groups:
+                counters = stats[group.id].counters
+                counters['files'] = 1
+                counters['bytes'] = size
+                counters['groups'] = len(groups)
+            attachments = cls.get_csb58_attachments(groups)
+            IrAttachment.delete(sum(attachments.values(), []))
+            cls.attach_paths([(g, path) for g in groups], stats=stats)
+            cls.write(list(groups), {
+                    'csb58_fingerprint': None,
+                    })
+        finally:
+            os.remove(path)
+        level = getattr(logging, config.get('account_payment_es_csb_58',
+                'log_level', default='INFO').upper(), logging.INFO)
+        if logger.isEnabledFor(level):
+            logger.log(level, 'Consolidated CSB 58 file of groups %s: '
+                'render=%.3fs %s', [g.id for g in groups], duration,
+                ' '.join('%s: %s' % (g.id, stats[g.id]) for g in groups))
+        return stats
+
+    @classmethod
+    def process_csb58_queue(cls):
+        """
+        Process the CSB 58 groups queued by journals that process them in
+        the background.
+
+        It is run by a cron and each group is processed in its own
+        transaction. A group is only claimed if it can be locked and it is
+        still queued, so many workers can run the cron at once. Failed groups
+        are queued again until they have been tried the number of times of
+        the "retries" option of the account_payment_es_csb_58 section of the
+        configuration (3 by default).
+
+        The worker processing a group keeps it locked, so a group that is
+        still processing but can be locked and has not been written for the
+        seconds of the "processing_timeout" option of the same section (300
+        by default) was left by a worker that died. It is claimed again as a
+        failed attempt.
+
+        The groups are processed as root, as the user of the cron has no
+        company, with the company of each group in the context.
+        """
+        retries = config.getint('account_payment_es_csb_58', 'retries',
+            default=3)
+        timeout = datetime.timedelta(seconds=config.getint(
+                'account_payment_es_csb_58', 'processing_timeout',
+                default=300))
+        interrupted = cls.raise_user_error('csb58_interrupted',
+            raise_exception=False)
+        # The cron user has no company, so the groups of every company are
+        # searched and processed as root in the context of their company
+        with Transaction().set_user(0):
+            groups = cls.search([
+                    ('csb58_state', 'in', ['queued', 'processing']),
+                    ], order=[('id', 'ASC')])
+            queue = [(g.id, g.company.id) for g in groups]
+        for group_id, company_id in queue:
+            with Transaction().set_user(0), \
+                    Transaction().set_context(company=company_id):
+                with Transaction().new_transaction() as transaction:
+                    try:
+                        cls.lock_csb58([cls(group_id)])
+                    except UserError:
+                        # Claimed by another worker
+                        transaction.rollback()
+                        continue
+                    group = cls(group_id)
+                    attempts = group.csb58_attempts or 0
+                    if group.csb58_state == 'processing':
+                        if (group.write_date or group.create_date
+                                ) > datetime.datetime.now() - timeout:
+                            # The worker may not have locked it yet
+                            transaction.rollback()
+                            continue
+                        logger.warning('CSB 58 group %s was interrupted on '
+                            'attempt %s', group_id, attempts)
+                        if attempts >= retries:
+                            cls.write([group], {
+                                    'csb58_state': 'failed',
+                                    'csb58_message': interrupted,
+                                    })
+                            transaction.commit()
+                            continue
+                    elif group.csb58_state != 'queued':
+                        transaction.rollback()
+                        continue
+                    attempts += 1
+                    # Commit the state so the progress is seen by the users
+                    cls.write([group], {
+                            'csb58_state': 'processing',
+                            'csb58_attempts': attempts,
+                            'csb58_message': None,
+                            })
+                    transaction.commit()
+                with Transaction().new_transaction() as transaction:
+                    try:
+                        group = cls(group_id)
+                        stats = cls.process_csb58_groups([group])
+                        cls.write([group], {
+                                'csb58_state': 'done',
+                                'csb58_message': str(stats[group_id]),
+                                })
+                        transaction.commit()
+                        continue
+                    except Exception as e:
+                        transaction.rollback()
+                        logger.exception(
+                            'CSB 58 group %s failed on attempt %s',
+                            group_id, attempts)
+                        message = getattr(e, 'message', None) or str(e)
+                with Transaction().new_transaction() as transaction:
+                    cls.write([cls(group_id)], {
+                            'csb58_state': ('queued' if attempts < retries
+                                else 'failed'),
+                            'csb58_message': message,
+                            })
+                    transaction.commit()
+
+
+class Payment(metaclass=PoolMeta):
+    __name__ = 'account.payment'
+    csb58_record = fields.Text('CSB 58 Record', readonly=True)
+    csb58_return_code = fields.Char('CSB 58 Return Code', readonly=True)
+    csb58_record_date = fields.Date('CSB 58 Record Date', readonly=True,
+        help='The only date the record is valid on as its due date is the '
+        'date it was written.')
+    # Fields the CSB 58 record of a payment depends on
+    _csb58_record_fields = {'journal', 'party', 'bank_account', 'amount',
+        'description', 'line'}
+
+    @classmethod
+    def copy(cls, payments, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('csb58_record', None)
+        default.setdefault('csb58_record_date', None)
+        default.setdefault('csb58_return_code', None)
+        return super(Payment, cls).copy(payments, default=default)
+
+    @classmethod
+    def create(cls, vlist):
+        payments = super(Payment, cls).create(vlist)
+        cls.cache_csb58_records(payments)
+        return payments
+
+    @classmethod
+    def write(cls, *args):
+        super(Payment, cls).write(*args)
+        actions = iter(args)
+        to_cache = []
+        for payments, values in zip(actions, actions):
+            if cls._csb58_record_fields & set(values):
+                to_cache.extend(p.id for p in payments)
+        if to_cache:
+            cls.cache_csb58_records(cls.browse(to_cache))
+
+    @classmethod
+    def clear_csb58_records(cls, domain):
+        '''
+        Clear the cached CSB 58 records of the payments of any company that
+        match domain, so they are rendered again with the current values.
+        '''
+        with Transaction().set_user(0):
+            payments = cls.search([
+                    domain,
+                    ('csb58_record', '!=', None),
+                    ])
+            if payments:
+                cls.write(payments, {
+                        'csb58_record': None,
+                        'csb58_record_date': None,
+                        })
+
+    @classmethod
+    def cache_csb58_records(cls, payments):
+        """
+        Write the CSB 58 records of the payments of incremental journals,
+        as they would be written in a group that does not join payments, and
+        clear them from the rest.
+
+        Payments whose records can not be written yet, for example because
+        of a missing address, are left without them and will be rendered
+        when their group is processed.
+        """
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        Date = pool.get('ir.date')
+        today = Date.today()
+        by_journal = {}
+        to_clear = []
+        for payment in payments:
+            journal = payment.journal
+            if (journal.process_method == 'csb58'
+                    and journal.csb58_incremental):
+                by_journal.setdefault(journal, []).append(payment)
+            elif payment.csb58_record:
+                to_clear.append(payment)
+        to_write = []
+        for journal, journal_payments in by_journal.items():
+            # The same payment may be given many times by a write
+            journal_payments = list(dict(
+                    (p.id, p) for p in journal_payments).values())
+            # The records only depend on the journal of the group
+            group = Group(journal=journal, join=False, planned_date=None)
+            try:
+                values = group.set_default_csb58_payment_values(
+                    payment_ids=[p.id for p in journal_payments],
+                    use_cache=False)
+            except UserError as e:
+                logger.debug('CSB 58 records of payments %s not cached: %s',
+                    [p.id for p in journal_payments], e.message)
+                to_clear.extend(journal_payments)
+                continue
+            write_receipt = csb58.receipt_writer(values)
+            # The receipts are sorted by payment id, not in the given order
+            receipts = dict((r.payment, r) for r in values['receipts'])
+            for payment in journal_payments:
+                receipt = receipts.get(payment.id)
+                if receipt is None:
+                    to_clear.append(payment)
+                    continue
+                to_write.extend([[payment], {
+                            'csb58_record': csb58.SEPARATOR.join(
+                                write_receipt(receipt)),
+                            'csb58_record_date': (today
+                                if receipt.due_date == today else None),
+                            }])
+        if to_clear:
+            to_write.extend([to_clear, {
+                        'csb58_record': None,
+                        'csb58_record_date': None,
+                        }])
+        if to_write:
+            # Skip the write of this class as it would cache them again
+            super(Payment, cls).write(*to_write)
+
+
+class ImportCSB58ReturnStart(ModelView):
+    'Import CSB 58 Return Start'
+    __name__ = 'account.payment.csb58.return.start'
+    file = fields.Binary('File', required=True)
+
+
+class ImportCSB58ReturnResult(ModelView):
+    'Import CSB 58 Return Result'
+    __name__ = 'account.payment.csb58.return.result'
+    failed = fields.Integer('Failed Payments', readonly=True)
+    report = fields.Text('Report', readonly=True,
+        help='Returned receipts that did not fail any payment.')
+
+
+class ImportCSB58Return(Wizard):
+    'Import CSB 58 Return'
+    __name__ = 'account.payment.csb58.return'
+    start = StateView('account.payment.csb58.return.start',
+        'account_payment_es_csb_58.csb58_return_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    result = StateView('account.payment.csb58.return.result',
+        'account_payment_es_csb_58.csb58_return_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    @classmethod
+    def __setup__(cls):
+        super(ImportCSB58Return, cls).__setup__()
+        cls._error_messages.update({
+                'return_without_payment': ('Receipt "%(reference)s" of '
+                    '%(amount)s: its concept does not start with a payment.'),
+                'return_payment_not_found': ('Receipt "%(reference)s" of '
+                    '%(amount)s: payment %(payment)s does not exist or can '
+                    'not be failed.'),
+                'return_mismatch': ('Receipt "%(reference)s" of '
+                    '%(amount)s: payment %(payment)s is of party '
+                    '"%(party_reference)s" and %(payment_amount)s.'),
+                })
+
+    def transition_import_(self):
+        """
+        Fail the payments of the receipts returned with a return code.
+
+        Each receipt is matched to the payment its concept starts with and
+        the payment is only failed if the reference and the amount of the
+        receipt are the ones written for it. Joined receipts only name their
+        first payment so all the payments of its group with the same party
+        and bank account are failed and their amounts added. The receipts
+        that do not fail any payment are reported.
+        """
+        Payment = Pool().get('account.payment')
+
+        report = []
+
+        def add_report(error, receipt, **values):
+            values.update(reference=receipt.reference,
+                amount=receipt.amount, payment=receipt.payment)
+            report.append(self.raise_user_error(error, values,
+                    raise_exception=False))
+
+        returned = {}
+        for receipt in csb58.iter_returns(BytesIO(self.start.file)):
+            if receipt.payment is None:
+                add_report('return_without_payment', receipt)
+            else:
+                returned[receipt.payment] = receipt
+
+        states = ['processing', 'succeeded']
+        found = {}
+        for sub_ids in grouped_slice(list(returned)):
+            for payment in Payment.search([
+                        ('id', 'in', list(sub_ids)),
+                        ('state', 'in', states),
+                        ]):
+                found[payment.id] = payment
+        for payment_id, receipt in returned.items():
+            if payment_id not in found:
+                add_report('return_payment_not_found', receipt)
+
+        def key(payment):
+            return (payment.group.id, payment.party.id,
+                payment.bank_account and payment.bank_account.id)
+        joined = dict((key(p), p.id) for p in found.values()
+            if p.group and p.group.join)
+        receipt_payments = dict((i, [p]) for i, p in found.items())
+        if joined:
+            for payment_id in joined.values():
+                receipt_payments[payment_id] = []
+            for payment in Payment.search([
+                        ('group', 'in', list({k[0] for k in joined})),
+                        ('state', 'in', states),
+                        ]):
+                payment_id = joined.get(key(payment))
+                if payment_id is not None:
+                    receipt_payments[payment_id].append(payment)
+
+        by_code = {}
+        for payment_id, payments in receipt_payments.items():
+            receipt = returned[payment_id]
+            payment = found[payment_id]
+            if len(payments) > 1:
+                amount = abs(sum(p.amount for p in payments))
+            else:
+                amount = abs(payment.amount)
+            # The reference is written as the normalized code of the party
+            reference = csb58.normalize(payment.party.code, 12).strip()
+            if receipt.reference != reference or receipt.amount != amount:
+                add_report('return_mismatch', receipt,
+                    party_reference=reference, payment_amount=amount)
+                continue
+            by_code.setdefault(receipt.return_code, []).extend(payments)
+
+        to_write = []
+        to_fail = []
+        for return_code, code_payments in by_code.items():
+            to_write.extend([code_payments, {
+                        'csb58_return_code': return_code,
+                        }])
+            to_fail.extend(code_payments)
+        if to_write:
+            Payment.write(*to_write)
+            Payment.fail(to_fail)
+        self.result.failed = len(to_fail)
+        self.result.report = '\n'.join(report)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'failed': self.result.failed,
+            'report': self.result.report,
+            }
+
+
+class ConsolidateCSB58(Wizard):
+    'Consolidate CSB 58 Files'
+    __name__ = 'account.payment.group.csb58.consolidate'
+    start_state = 'consolidate'
+    consolidate = StateTransition()
+
+    def transition_consolidate(self):
+        Group = Pool().get('account.payment.group')
+        groups = Group.browse(Transaction().context['active_ids'])
+        Group.process_csb58_consolidated(groups)
+        return 'end'
@@ -0,0 +1,313 @@
+# This file is part of the account_payment_es_csb_58 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Benchmark of the generation of CSB 58 files.
+
+For each size it fabricates a company, a journal, parties with addresses and
+bank accounts and a group of payments and reports the wall time, the number
+of SQL queries and the peak memory of each phase of process_csb58, including
+the validation of the generated file, with and without joining the payments
+and including the domicile records or not.
+
+It runs on an in-memory SQLite database by default:
+
+    python -m trytond.modules.account_payment_es_csb_58.tests.benchmark_csb58 \\
+        1000 10000 100000
+
+The peak memory is the one traced by tracemalloc, which slows down the
+phases it measures.
+
+Before that it reports the time a new interpreter takes to import the module,
+the libraries it leaves to be loaded on first use and the time of that first
+use, which every process running the module pays once.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from decimal import Decimal
+
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond.tests.test_tryton import activate_module, with_transaction
+from trytond.pool import Pool
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.account_payment_es_csb_58 import csb58
+from trytond.modules.account_payment_es_csb_58.payment import count_queries
+
+MODULE = 'account_payment_es_csb_58'
+SIZES = (1000, 10000, 100000)
+# Number of payments of each party so joined groups have something to join
+PAYMENTS_PER_PARTY = 4
+BATCH = 1000
+# Libraries that are only loaded when a file is written or checked
+LAZY_MODULES = ('retrofix', 'banknumber', 'multiprocessing')
+IMPORT_RUNS = 5
+# Run in a new interpreter so nothing is imported beforehand
+IMPORT_SCRIPT = '''
+import sys
+import time
+import trytond.pool
+start = time.perf_counter()
+from trytond.modules.%(module)s import csb58, payment
+imported = time.perf_counter() - start
+loaded = [m for m in %(lazy)r if m in sys.modules]
+start = time.perf_counter()
+csb58.load_retrofix()
+payment.check_bank_code('21000001050000000001')
+first_use = time.perf_counter() - start
+print(imported, first_use, ','.join(loaded) or '-')
+'''
+
+
+def ccc(number):
+    'Return a valid spanish bank account code built from number'
+    weights = (1, 2, 4, 8, 5, 10, 9, 7, 3, 6)
+
+    def control(digits):
+        digit = 11 - sum(int(d) * w for d, w in zip(digits, weights)) % 11
+        return {10: 1, 11: 0}.get(digit, digit)
+    entity = '21000001'
+    account = str(number).zfill(10)
+    return '%s%s%s%s' % (entity, control('00' + entity), control(account),
+        account)
+
+
+def iban(number):
+    'Return the spanish IBAN of the bank account code built from number'
+    code = ccc(number)
+    # E is 14 and S is 28 when the country is moved to the end
+    check = 98 - int(code + '142800') % 97
+    return 'ES%02d%s' % (check, code)
+
+
+@contextmanager
+def measure(results, phase):
+    'Store the wall time, queries and peak memory of the block in results'
+    # The phases of process_csb58 count their queries in nested blocks
+    with count_queries() as queries:
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results.append((phase, elapsed, queries.value, peak))
+
+
+def create_bank_accounts(bank, parties):
+    'Create and return one bank account for each party'
+    BankAccount = Pool().get('bank.account')
+    accounts = []
+    for start in range(0, len(parties), BATCH):
+        accounts.extend(BankAccount.create([{
+                        'bank': bank.id,
+                        'owners': [('add', [p.id])],
+                        'numbers': [('create', [{
+                                        'type': 'iban',
+                                        'number': iban(p.id),
+                                        }])],
+                        } for p in parties[start:start + BATCH]]))
+    return accounts
+
+
+def create_parties(count, country, subdivision):
+    'Create count parties with a complete invoice address'
+    Party = Pool().get('party.party')
+    parties = []
+    for start in range(0, count, BATCH):
+        parties.extend(Party.create([{
+                        'name': 'Party %s' % i,
+                        'addresses': [('create', [{
+                                        'street': 'Street %s' % i,
+                                        'zip': '08001',
+                                        'city': 'Barcelona',
+                                        'country': country.id,
+                                        'subdivision': subdivision.id,
+                                        'invoice': True,
+                                        }])],
+                        } for i in range(start, min(start + BATCH, count))]))
+    return parties
+
+
+def set_vat_number(party, code):
+    Party = Pool().get('party.party')
+    if 'identifiers' in Party._fields:
+        Party.write([party], {
+                'identifiers': [('create', [{
+                                'type': 'eu_vat',
+                                'code': code,
+                                }])],
+                })
+    else:
+        Party.write([party], {'vat_number': code})
+
+
+def setup(company):
+    'Create the journal and the parties shared by all the benchmarks'
+    pool = Pool()
+    Bank = pool.get('bank')
+    Country = pool.get('country.country')
+    Subdivision = pool.get('country.subdivision')
+    Party = pool.get('party.party')
+    Journal = pool.get('account.payment.journal')
+
+    country, = Country.create([{'name': 'Spain', 'code': 'ES'}])
+    subdivision, = Subdivision.create([{
+                'name': 'Barcelona',
+                'code': 'ES-B',
+                'type': 'province',
+                'country': country.id,
+                }])
+    set_vat_number(company.party, 'ESB12345674')
+    Party.write([company.party], {
+            'addresses': [('create', [{
+                            'street': 'Company street',
+                            'zip': '08001',
+                            'city': 'Barcelona',
+                            'country': country.id,
+                            'subdivision': subdivision.id,
+                            'invoice': True,
+                            }])],
+            })
+    bank_party, = Party.create([{'name': 'Bank'}])
+    bank, = Bank.create([{'party': bank_party.id}])
+    company_account, = create_bank_accounts(bank, [company.party])
+    journal, = Journal.create([{
+                'name': 'CSB 58',
+                'company': company.id,
+                'currency': company.currency.id,
+                'process_method': 'csb58',
+                'sepa_bank_account_number': company_account.numbers[0].id,
+                'party': company.party.id,
+                'suffix': '000',
+                'ine_code': '08019',
+                'require_bank_account': True,
+                }])
+    return journal, bank, country, subdivision
+
+
+def create_group(journal, parties, accounts, size, join):
+    'Create a group with size payments spread over parties'
+    pool = Pool()
+    Group = pool.get('account.payment.group')
+    Payment = pool.get('account.payment')
+    Date = pool.get('ir.date')
+
+    group, = Group.create([{
+                'journal': journal.id,
+                'company': journal.company.id,
+                'kind': 'receivable',
+                'join': join,
+                }])
+    today = Date.today()
+    for start in range(0, size, BATCH):
+        Payment.create([{
+                    'journal': journal.id,
+                    'company': journal.company.id,
+                    'kind': 'receivable',
+                    'party': parties[i % len(parties)].id,
+                    'bank_account': accounts[i % len(accounts)].id,
+                    'amount': Decimal('10.00'),
+                    'description': 'Payment %s' % i,
+                    'date': today,
+                    'state': 'processing',
+                    'group': group.id,
+                    } for i in range(start, min(start + BATCH, size))])
+    return group
+
+
+def benchmark(company, journal, bank, country, subdivision, size, join,
+        include_domicile):
+    pool = Pool()
+    Group = pool.get('account.payment.group')
+    Journal = pool.get('account.payment.journal')
+
+    Journal.write([journal], {
+            'csb58_include_domicile': include_domicile,
+            })
+    parties = create_parties(max(1, size // PAYMENTS_PER_PARTY),
+        country, subdivision)
+    accounts = create_bank_accounts(bank, parties)
+    group = create_group(journal, parties, accounts, size, join)
+
+    results = []
+    # Start from a cold cache as a new request would
+    group = Group(group.id)
+    with measure(results, 'values'):
+        values = group.set_default_csb58_payment_values()
+    with measure(results, 'render'):
+        path = csb58.render_to_file(values)
+    try:
+        with measure(results, 'validate'):
+            csb58.validate_file(path)
+        with measure(results, 'attach'):
+            Group.attach_paths([(group, path)])
+    finally:
+        os.remove(path)
+    return results
+
+
+def measure_imports(output, runs=IMPORT_RUNS):
+    'Write the median time to import the module and to first use it'
+    script = IMPORT_SCRIPT % {'module': MODULE, 'lazy': LAZY_MODULES}
+    imports, first_uses = [], []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', script],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        imported, first_use, loaded = result.stdout.split()
+        imports.append(float(imported))
+        first_uses.append(float(first_use))
+    output.write('%-10s %10s %-30s\n' % ('phase', 'seconds',
+            'lazy modules loaded'))
+    output.write('%-10s %10.3f %-30s\n' % ('import',
+            statistics.median(imports), loaded))
+    output.write('%-10s %10.3f\n\n' % ('first use',
+            statistics.median(first_uses)))
+    output.flush()
+
+
+@with_transaction()
+def run(sizes, output):
+    company = create_company()
+    with set_company(company):
+        journal, bank, country, subdivision = setup(company)
+        output.write('%8s %6s %8s %-10s %10s %8s %12s\n' % ('size', 'join',
+                'domicile', 'phase', 'seconds', 'queries', 'peak KiB'))
+        for size in sizes:
+            for join in (False, True):
+                for include_domicile in (False, True):
+                    results = benchmark(company, journal, bank, country,
+                        subdivision, size, join, include_domicile)
+                    for phase, elapsed, queries, peak in results:
+                        output.write('%8s %6s %8s %-10s %10.3f %8s %12d\n' % (
+                                size, join, include_domicile, phase, elapsed,
+                                '-' if queries is None else queries,
+                                peak // 1024))
+                    output.flush()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the generation of CSB 58 files')
+    parser.add_argument('sizes', metavar='SIZE', type=int, nargs='*',
+        default=SIZES, help='number of payments of each group')
+    parser.add_argument('--import-runs', type=int, default=IMPORT_RUNS,
+        help='number of interpreters started to measure the import')
+    options = parser.parse_args(args)
+    if options.import_runs:
+        measure_imports(sys.stdout, options.import_runs)
+    activate_module(MODULE)
+    run(options.sizes, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
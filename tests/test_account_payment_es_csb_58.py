@@ -1,18 +1,936 @@
 # This file is part of the account_payment_es_csb_58 module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
+import os
 import unittest
+from decimal import Decimal
+from io import BytesIO
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+
+from retrofix import c58
+from retrofix.record import Record
+
+from trytond.modules.account_payment_es_csb_58 import csb58
+from trytond.modules.account_payment_es_csb_58.payment import count_queries
+
+
+# IBAN of a valid spanish bank account code
+IBAN = 'ES2121000001050000000001'
+
+
+def create_journal(company, **values):
+    'Create a CSB 58 journal of company with a complete presenter'
+    pool = Pool()
+    Bank = pool.get('bank')
+    BankAccount = pool.get('bank.account')
+    Country = pool.get('country.country')
+    Subdivision = pool.get('country.subdivision')
+    Party = pool.get('party.party')
+    Journal = pool.get('account.payment.journal')
+
+    country, = Country.create([{'name': 'Spain', 'code': 'ES'}])
+    subdivision, = Subdivision.create([{
+                'name': 'Barcelona',
+                'code': 'ES-B',
+                'type': 'province',
+                'country': country.id,
+                }])
+    if 'identifiers' in Party._fields:
+        Party.write([company.party], {
+                'identifiers': [('create', [{
+                                'type': 'eu_vat',
+                                'code': 'ESB12345674',
+                                }])],
+                })
+    else:
+        Party.write([company.party], {'vat_number': 'ESB12345674'})
+    Party.write([company.party], {
+            'addresses': [('create', [{
+                            'street': 'Company street',
+                            'zip': '08001',
+                            'city': 'Barcelona',
+                            'country': country.id,
+                            'subdivision': subdivision.id,
+                            'invoice': True,
+                            }])],
+            })
+    bank_party, = Party.create([{'name': 'Bank'}])
+    bank, = Bank.create([{'party': bank_party.id}])
+    account, = BankAccount.create([{
+                'bank': bank.id,
+                'owners': [('add', [company.party.id])],
+                'numbers': [('create', [{
+                                'type': 'iban',
+                                'number': IBAN,
+                                }])],
+                }])
+    journal_values = {
+        'name': 'CSB 58',
+        'company': company.id,
+        'currency': company.currency.id,
+        'process_method': 'csb58',
+        'sepa_bank_account_number': account.numbers[0].id,
+        'party': company.party.id,
+        'suffix': '000',
+        'ine_code': '08019',
+        'require_bank_account': True,
+        }
+    journal_values.update(values)
+    journal, = Journal.create([journal_values])
+    return journal
+
+
+def create_parties(journal, names):
+    'Create a party with an address and a bank account for each name'
+    pool = Pool()
+    Party = pool.get('party.party')
+    BankAccount = pool.get('bank.account')
+    address, = journal.company.party.addresses
+    bank = journal.sepa_bank_account_number.account.bank
+    parties = Party.create([{
+                'name': name,
+                'addresses': [('create', [{
+                                'street': 'Street',
+                                'zip': '08001',
+                                'city': 'Barcelona',
+                                'country': address.country.id,
+                                'subdivision': address.subdivision.id,
+                                'invoice': True,
+                                }])],
+                } for name in names])
+    accounts = BankAccount.create([{
+                'bank': bank.id,
+                'owners': [('add', [p.id])],
+                'numbers': [('create', [{
+                                'type': 'iban',
+                                'number': IBAN,
+                                }])],
+                } for p in parties])
+    return parties, accounts
+
+
+def create_payments(journal, parties, accounts, amounts, group=None):
+    'Create a payment of each amount for the party and account in turn'
+    Payment = Pool().get('account.payment')
+    values = []
+    for i, amount in enumerate(amounts):
+        payment = {
+            'journal': journal.id,
+            'company': journal.company.id,
+            'kind': 'receivable',
+            'party': parties[i % len(parties)].id,
+            'bank_account': accounts[i % len(accounts)].id,
+            'amount': amount,
+            'description': 'Payment %s' % i,
+            }
+        if group:
+            payment['group'] = group.id
+            payment['state'] = 'processing'
+        values.append(payment)
+    return Payment.create(values)
+
+
+def create_group(journal, join=False):
+    Group = Pool().get('account.payment.group')
+    group, = Group.create([{
+                'journal': journal.id,
+                'company': journal.company.id,
+                'kind': 'receivable',
+                'join': join,
+                }])
+    return group
+
+
+def get_attachments(group):
+    'Return the attachments of group sorted by name'
+    Attachment = Pool().get('ir.attachment')
+    return Attachment.search([
+            ('resource', '=', str(group)),
+            ], order=[('name', 'ASC')])
+
+
+def run_queue():
+    'Commit and run the CSB 58 queue as the cron user, who has no company'
+    pool = Pool()
+    Group = pool.get('account.payment.group')
+    ModelData = pool.get('ir.model.data')
+    transaction = Transaction()
+    # The queue processes each group in a new transaction
+    transaction.commit()
+    user = ModelData.get_id('res', 'user_trigger')
+    with transaction.set_user(user), transaction.set_context(company=None):
+        Group.process_csb58_queue()
+
+
+def queue_state(group):
+    'Return the state, attempts and message of group read from the database'
+    Group = Pool().get('account.payment.group')
+    values, = Group.read([group.id], ['csb58_state', 'csb58_attempts',
+            'csb58_message'])
+    return (values['csb58_state'], values['csb58_attempts'],
+        values['csb58_message'])
+
+
+def record_amount(amount):
+    'Return amount as written in the individual records'
+    return '%010d' % (amount * 100)
 
 
 class AccountPaymentEsCsb58TestCase(ModuleTestCase):
     'Test Account Payment Es Csb 58 module'
     module = 'account_payment_es_csb_58'
 
+    @with_transaction()
+    def test_cache_records_unsorted_write(self):
+        'Test records cached on payments written in any order'
+        Payment = Pool().get('account.payment')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company, csb58_incremental=True)
+            parties, accounts = create_parties(journal, ['Party 1',
+                    'Party 2'])
+            p1, p2 = create_payments(journal, parties, accounts,
+                [Decimal('10'), Decimal('20')])
+            self.assertLess(p1.id, p2.id)
+
+            Payment.write([p2, p1], {'description': 'Changed'},
+                [p2], {'amount': Decimal('30')})
+            for payment, amount in [(p1, Decimal('10')),
+                    (p2, Decimal('30'))]:
+                payment = Payment(payment.id)
+                record = payment.csb58_record.split(csb58.SEPARATOR)[0]
+                self.assertEqual(record[16:28].strip(), payment.party.code)
+                self.assertEqual(record[88:98], record_amount(amount))
+
+    @with_transaction()
+    def test_cache_records_cleared(self):
+        'Test records cached on payments cleared when their inputs change'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        Number = pool.get('bank.account.number')
+        Payment = pool.get('account.payment')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company, csb58_incremental=True)
+            parties, accounts = create_parties(journal, ['Party 1',
+                    'Party 2', 'Other'])
+            p1, p2 = create_payments(journal, parties[:2], accounts[:2],
+                [Decimal('10'), Decimal('20')])
+
+            def cached():
+                return [bool(p.csb58_record)
+                    for p in Payment.browse([p1.id, p2.id])]
+            self.assertEqual(cached(), [True, True])
+
+            Party.write([parties[2]], {'name': 'Renamed'})
+            self.assertEqual(cached(), [True, True])
+
+            # A corrected IBAN of the debtor
+            Number.write(list(accounts[0].numbers), {
+                    'number': 'ES7921000813610123456789',
+                    })
+            self.assertEqual(cached(), [False, True])
+
+            Address.write(list(parties[1].addresses), {'city': 'Girona'})
+            self.assertEqual(cached(), [False, False])
+
+            Payment.write([p1, p2], {'description': 'Cached again'})
+            self.assertEqual(cached(), [True, True])
+
+            # The presenter gives the NIF and ordering address of all
+            Party.write([journal.party], {'name': 'Presenter'})
+            self.assertEqual(cached(), [False, False])
+
+    @with_transaction()
+    def test_joined_group_ignores_cache(self):
+        'Test payments of a party joined in a receipt'
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company, csb58_incremental=True)
+            parties, accounts = create_parties(journal, ['Party 1',
+                    'Party 2'])
+            group = create_group(journal, join=True)
+            create_payments(journal, parties, accounts,
+                [Decimal('10'), Decimal('20'), Decimal('5')], group=group)
+            values = group.set_default_csb58_payment_values()
+            self.assertEqual(sorted(r.amount for r in values['receipts']),
+                [Decimal('15'), Decimal('20')])
+            self.assertFalse(any(r.records for r in values['receipts']))
+            self.assertEqual(values['amount'], Decimal('35'))
+
+    @with_transaction()
+    def test_process(self):
+        'Test the file attached once and reused until the group changes'
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        Payment = pool.get('account.payment')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company)
+            parties, accounts = create_parties(journal, ['Party 1',
+                    'Party 2'])
+            group = create_group(journal)
+            payments = create_payments(journal, parties, accounts,
+                [Decimal('10'), Decimal('20')], group=group)
+
+            Group.process_csb58(group)
+            attachment, = get_attachments(group)
+            self.assertEqual(attachment.name,
+                'remittance_csb58_%s' % group.reference)
+            for phase in ['fingerprint', 'values', 'render', 'validate']:
+                self.assertIn(phase + '=', attachment.description)
+            self.assertIn('files=1', attachment.description)
+            totals = csb58.validate(attachment.data)
+            self.assertEqual(totals.amount, Decimal('30'))
+            self.assertEqual(Group(group.id).csb58_fingerprint,
+                group.get_csb58_fingerprint())
+
+            # Nothing changed so the file is kept
+            stats = Group.process_csb58_groups([Group(group.id)])
+            self.assertEqual(stats[group.id].counters, {'reused': 1})
+            self.assertEqual(get_attachments(group), [attachment])
+
+            # The new file replaces the previous one
+            Payment.write([payments[0]], {'amount': Decimal('15')})
+            Group.process_csb58(Group(group.id))
+            new_attachment, = get_attachments(group)
+            self.assertNotEqual(new_attachment, attachment)
+            totals = csb58.validate(new_attachment.data)
+            self.assertEqual(totals.amount, Decimal('35'))
+
+    @with_transaction()
+    def test_process_chunk_files(self):
+        'Test the receipts of a group split in numbered files'
+        Group = Pool().get('account.payment.group')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company, csb58_chunk_size=2,
+                csb58_chunk_mode='file')
+            parties, accounts = create_parties(journal, ['Party 1',
+                    'Party 2', 'Party 3'])
+            group = create_group(journal)
+            create_payments(journal, parties, accounts,
+                [Decimal('10'), Decimal('20'), Decimal('30')], group=group)
+
+            stats = Group.process_csb58_groups([group])
+            self.assertEqual(stats[group.id].counters['files'], 2)
+            attachments = get_attachments(group)
+            self.assertEqual([a.name for a in attachments],
+                ['remittance_csb58_%s_%s' % (group.reference, i)
+                    for i in (1, 2)])
+            self.assertEqual([csb58.validate(a.data).individual_records
+                    for a in attachments], [2, 1])
+
+    @with_transaction()
+    def test_process_groups(self):
+        'Test the files of many groups attached at once'
+        Group = Pool().get('account.payment.group')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company)
+            parties, accounts = create_parties(journal, ['Party 1'])
+            groups = [create_group(journal), create_group(journal)]
+            for group, amount in zip(groups, [Decimal('10'),
+                        Decimal('20')]):
+                create_payments(journal, parties, accounts, [amount],
+                    group=group)
+
+            stats = Group.process_csb58_groups(groups)
+            self.assertEqual(sorted(stats), sorted(g.id for g in groups))
+            for group, amount in zip(groups, [Decimal('10'),
+                        Decimal('20')]):
+                attachment, = get_attachments(group)
+                self.assertEqual(attachment.description,
+                    str(stats[group.id]))
+                self.assertEqual(csb58.validate(attachment.data).amount,
+                    amount)
+
+    @with_transaction()
+    def test_process_consolidated(self):
+        'Test a file with the groups of many suffixes of a presenter'
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        Journal = pool.get('account.payment.journal')
+        Consolidate = pool.get('account.payment.group.csb58.consolidate',
+            type='wizard')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company)
+            other_journal, = Journal.copy([journal], {
+                    'name': 'CSB 58 001',
+                    'suffix': '001',
+                    })
+            parties, accounts = create_parties(journal, ['Party 1'])
+            groups = []
+            for group_journal, amount in [(journal, Decimal('10')),
+                    (other_journal, Decimal('20'))]:
+                group = create_group(group_journal)
+                create_payments(group_journal, parties, accounts, [amount],
+                    group=group)
+                groups.append(group)
+            Group.process_csb58(groups[0])
+
+            session_id, _, _ = Consolidate.create()
+            consolidate = Consolidate(session_id)
+            with Transaction().set_context(
+                    active_ids=[g.id for g in groups]):
+                self.assertEqual(consolidate.transition_consolidate(),
+                    'end')
+            attachments = [get_attachments(g) for g in groups]
+            self.assertEqual([len(a) for a in attachments], [1, 1])
+            data = attachments[0][0].data
+            self.assertEqual(attachments[1][0].data, data)
+            totals = csb58.validate(data)
+            self.assertEqual((totals.blocks, totals.amount),
+                (2, Decimal('30')))
+            self.assertEqual([Group(g.id).csb58_fingerprint for g in groups],
+                [None, None])
+
+    @with_transaction()
+    def test_summary(self):
+        'Test summary only computed for the groups of CSB 58 journals'
+        Group = Pool().get('account.payment.group')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company)
+            manual_journal = create_journal(company, process_method='manual')
+            parties, accounts = create_parties(journal, ['Party 1'])
+            groups = []
+            for group_journal in [journal, manual_journal]:
+                group = create_group(group_journal)
+                create_payments(group_journal, parties, accounts,
+                    [Decimal('10'), Decimal('5')], group=group)
+                groups.append(group)
+            group, manual_group = Group.browse([g.id for g in groups])
+            self.assertEqual((group.csb58_receipts, group.csb58_amount),
+                (2, Decimal('15')))
+            self.assertEqual(
+                (manual_group.csb58_receipts, manual_group.csb58_amount),
+                (None, None))
+
+    @with_transaction()
+    def test_queue(self):
+        'Test groups processed in the background by the queue'
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        Attachment = pool.get('ir.attachment')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company, csb58_background=True)
+            parties, accounts = create_parties(journal, ['Party 1'])
+            group = create_group(journal)
+            create_payments(journal, parties, accounts, [Decimal('10')],
+                group=group)
+            Group.process_csb58(group)
+            self.assertEqual(queue_state(group), ('queued', 0, None))
+            self.assertEqual(Attachment.search([
+                        ('resource', '=', str(group)),
+                        ]), [])
+
+        run_queue()
+        state, attempts, message = queue_state(group)
+        self.assertEqual((state, attempts), ('done', 1))
+        self.assertIn('render=', message)
+        self.assertEqual(len(Attachment.search([
+                        ('resource', '=', str(group)),
+                        ])), 1)
+
+    @with_transaction()
+    def test_queue_retries(self):
+        'Test failed groups queued again until they run out of retries'
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        Payment = pool.get('account.payment')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company, csb58_background=True)
+            parties, accounts = create_parties(journal, ['Party 1'])
+            group = create_group(journal)
+            payments = create_payments(journal, parties, accounts,
+                [Decimal('10')], group=group)
+            Group.process_csb58(group)
+            Payment.write(payments, {'bank_account': None})
+
+        for attempts, state in [(1, 'queued'), (2, 'queued'),
+                (3, 'failed')]:
+            run_queue()
+            self.assertEqual(queue_state(group)[:2], (state, attempts))
+            self.assertTrue(queue_state(group)[2])
+        run_queue()
+        self.assertEqual(queue_state(group)[:2], ('failed', 3))
+
+    @with_transaction()
+    def test_queue_interrupted(self):
+        'Test groups left processing by a dead worker claimed again'
+        pool = Pool()
+        Group = pool.get('account.payment.group')
+        group_table = Group.__table__()
+        cursor = Transaction().connection.cursor()
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company, csb58_background=True)
+            parties, accounts = create_parties(journal, ['Party 1'])
+            groups = []
+            for _ in range(3):
+                group = create_group(journal)
+                create_payments(journal, parties, accounts,
+                    [Decimal('10')], group=group)
+                Group.process_csb58(group)
+                groups.append(group)
+            recent, dead, exhausted = groups
+
+        def set_processing(group, attempts, write_date):
+            cursor.execute(*group_table.update([
+                        group_table.csb58_state,
+                        group_table.csb58_attempts,
+                        group_table.write_date,
+                        ], ['processing', attempts, write_date],
+                    where=group_table.id == group.id))
+        now = datetime.datetime.now()
+        set_processing(recent, 1, now)
+        set_processing(dead, 1, now - datetime.timedelta(hours=1))
+        set_processing(exhausted, 3, now - datetime.timedelta(hours=1))
+
+        run_queue()
+        self.assertEqual(queue_state(recent)[:2], ('processing', 1))
+        self.assertEqual(queue_state(dead)[:2], ('done', 2))
+        state, attempts, message = queue_state(exhausted)
+        self.assertEqual((state, attempts), ('failed', 3))
+        self.assertTrue(message)
+
+    @with_transaction()
+    def test_import_return(self):
+        'Test returned receipts failing their payments'
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        ImportReturn = pool.get('account.payment.csb58.return',
+            type='wizard')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company)
+            parties, accounts = create_parties(journal, ['Party 1',
+                    'Party 2'])
+            group = create_group(journal)
+            p1, p2 = create_payments(journal, parties, accounts,
+                [Decimal('10'), Decimal('20')], group=group)
+            values = group.set_default_csb58_payment_values()
+            lines = csb58.render(values).split(csb58.SEPARATOR)
+            # The bank returns both receipts but the amount of the second
+            # one does not match its payment
+            lines[2] = lines[2][:98] + 'R01   ' + lines[2][104:]
+            lines[3] = (lines[3][:88] + record_amount(Decimal('25'))
+                + 'R02   ' + lines[3][104:])
+
+            session_id, _, _ = ImportReturn.create()
+            import_return = ImportReturn(session_id)
+            import_return.start.file = csb58.SEPARATOR.join(lines).encode(
+                csb58.ENCODING)
+            self.assertEqual(import_return.transition_import_(), 'result')
+            self.assertEqual(import_return.result.failed, 1)
+            self.assertEqual(len(import_return.result.report.splitlines()),
+                1)
+            p1, p2 = Payment.browse([p1.id, p2.id])
+            self.assertEqual((p1.state, p1.csb58_return_code),
+                ('failed', 'R01'))
+            self.assertEqual((p2.state, p2.csb58_return_code),
+                ('processing', None))
+
+    @with_transaction()
+    def test_records_nif(self):
+        'Test the NIF of the records has no country prefix'
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company)
+            parties, accounts = create_parties(journal, ['Party 1'])
+            group = create_group(journal)
+            create_payments(journal, parties, accounts, [Decimal('10')],
+                group=group)
+            values = group.set_default_csb58_payment_values()
+            lines = csb58.render(values).split(csb58.SEPARATOR)
+            for line in filter(None, lines):
+                self.assertEqual(line[4:13], 'B12345674')
+
+    @with_transaction()
+    def test_count_queries(self):
+        'Test queries counted by nested blocks'
+        Party = Pool().get('party.party')
+        transaction = Transaction()
+        connection = transaction.connection
+        with count_queries() as outer:
+            Party.search([])
+            with count_queries() as inner:
+                Party.search([])
+            self.assertGreater(inner.value, 0)
+            self.assertGreater(outer.value, inner.value)
+            after = outer.value
+        self.assertIs(transaction.connection, connection)
+        Party.search([])
+        self.assertEqual(outer.value, after)
+
+    @with_transaction()
+    def test_addresses_order(self):
+        'Test addresses found as address_get does'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        Group = pool.get('account.payment.group')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company)
+            parties, _ = create_parties(journal, ['Party 1'])
+            party, = parties
+            first, = party.addresses
+            Address.write([first], {'invoice': False, 'sequence': None})
+            Address.create([{
+                        'party': party.id,
+                        'city': 'Girona',
+                        'sequence': 1,
+                        }])
+            party = Party(party.id)
+            address = party.address_get(type='invoice')
+            self.assertEqual(address, first)
+            addresses = Group.get_csb58_addresses([party.id])
+            self.assertEqual(addresses[party.id]['city'], address.city)
+
+    @with_transaction()
+    def test_fingerprint(self):
+        'Test fingerprint changes with the inputs of the file'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Subdivision = pool.get('country.subdivision')
+        company = create_company()
+        with set_company(company):
+            presenter, = Party.create([{'name': 'Presenter'}])
+            journal = create_journal(company, party=presenter.id)
+            parties, accounts = create_parties(journal, ['Party 1'])
+            group = create_group(journal)
+            create_payments(journal, parties, accounts, [Decimal('10')],
+                group=group)
+            fingerprint = group.get_csb58_fingerprint()
+            self.assertEqual(group.get_csb58_fingerprint(), fingerprint)
+
+            # The company party gives its name to the headers
+            Party.write([company.party], {'name': 'Renamed'})
+            group = group.__class__(group.id)
+            changed = group.get_csb58_fingerprint()
+            self.assertNotEqual(changed, fingerprint)
+
+            # The subdivisions give the provinces
+            address, = parties[0].addresses
+            Subdivision.write([address.subdivision], {'code': 'ES-GI'})
+            group = group.__class__(group.id)
+            self.assertNotEqual(group.get_csb58_fingerprint(), changed)
+
+    @with_transaction()
+    def test_header_cache(self):
+        'Test header values cache is only cleared by the parties it uses'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Journal = pool.get('account.payment.journal')
+        company = create_company()
+        with set_company(company):
+            presenter, other = Party.create([
+                    {'name': 'Presenter'},
+                    {'name': 'Other'},
+                    ])
+            journal = create_journal(company, party=presenter.id)
+            journal.get_csb58_header_values()
+            self.assertIsNotNone(Journal._csb58_header_cache.get(journal.id))
+
+            Party.write([other], {'name': 'Renamed'})
+            self.assertIsNotNone(Journal._csb58_header_cache.get(journal.id))
+
+            Party.write([presenter], {'name': 'Renamed'})
+            self.assertIsNone(Journal._csb58_header_cache.get(journal.id))
+            journal = Journal(journal.id)
+            values, _ = journal.get_csb58_header_values()
+            self.assertEqual(values['name'], 'Renamed')
+
+    @with_transaction()
+    def test_get_errors(self):
+        'Test all the errors of a group reported without building it'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Address = pool.get('party.address')
+        Payment = pool.get('account.payment')
+        company = create_company()
+        with set_company(company):
+            journal = create_journal(company, csb58_include_domicile=True)
+            parties, accounts = create_parties(journal, ['Valid',
+                    'Without address', 'Without province', 'Without account'])
+            valid, without_address, without_province, _ = parties
+            Address.delete(list(without_address.addresses))
+            Address.write(list(without_province.addresses), {
+                    'subdivision': None,
+                    })
+            group = create_group(journal)
+            payments = create_payments(journal, parties, accounts,
+                [Decimal('10')] * 4, group=group)
+            Payment.write([payments[3]], {'bank_account': None})
+
+            errors = group.get_csb58_errors()
+            self.assertEqual(len(errors), 3)
+            self.assertEqual(errors.records('party_without_address'),
+                [(Party.__name__, without_address.id)])
+            self.assertEqual(errors.records('party_without_province'),
+                [(Party.__name__, without_province.id)])
+            self.assertEqual(errors.records('payment_without_bank_account'),
+                [(Payment.__name__, payments[3].id)])
+
+
+class Csb58TestCase(unittest.TestCase):
+    'Test CSB 58 file rendering'
+
+    def setUp(self):
+        self.values = {
+            'vat_code': 'B12345674',
+            'suffix': '000',
+            'creation_date': datetime.datetime(2016, 1, 1),
+            'company_name': 'Company',
+            'bank_account': '21000001050000000001',
+            'ine_code': '08019',
+            'include_domicile': True,
+            'city': 'Barcelona',
+            'province': '08',
+            }
+        self.receipts = [
+            csb58.Receipt(reference='P1', name='Party 1',
+                bank_account='21000001050000000001', amount=Decimal('10.5'),
+                concept='1 Invoice 1', due_date=datetime.datetime(2016, 3, 4),
+                street='Street 1', city='Barcelona', zip='08001',
+                origin_date=datetime.datetime(2016, 2, 1)),
+            csb58.Receipt(reference='P2' * 10, name='Ñame·+' * 10,
+                bank_account='21000001050000000001',
+                amount=Decimal('1234567.89'), concept=None,
+                due_date=datetime.datetime(2016, 12, 31), street=None,
+                city='A city name longer than the thirty five characters',
+                zip='08001', origin_date=datetime.datetime(2016, 1, 1)),
+            ]
+
+    def test_required_individual_template(self):
+        'Test required individual template writes as retrofix'
+        template = csb58.required_individual_template(self.values)
+        for receipt in self.receipts:
+            record = Record(c58.REQUIRED_INDIVIDUAL_RECORD)
+            record.record_code = '56'
+            record.data_code = '70'
+            record.nif = self.values['vat_code']
+            record.suffix = self.values['suffix']
+            record.reference = csb58.normalize(receipt.reference)
+            record.name = csb58.normalize(receipt.name)
+            record.account = receipt.bank_account
+            record.amount = receipt.amount
+            record.return_code = ''
+            record.internal_code = ''
+            record.concept = csb58.normalize(receipt.concept)
+            record.due_date = receipt.due_date
+            self.assertEqual(template.write(receipt.reference, receipt.name,
+                    receipt.bank_account, receipt.amount, receipt.concept,
+                    receipt.due_date), record.write())
+
+    def test_address_individual_template(self):
+        'Test address individual template writes as retrofix'
+        template = csb58.address_individual_template(self.values)
+        for receipt in self.receipts:
+            record = Record(c58.ADDRESS_INDIVIDUAL_RECORD)
+            record.record_code = '56'
+            record.data_code = '76'
+            record.nif = self.values['vat_code']
+            record.suffix = self.values['suffix']
+            record.reference = csb58.normalize(receipt.reference)
+            record.payer_address = csb58.normalize(receipt.street)
+            record.payer_city = csb58.normalize(receipt.city)
+            record.payer_zip = receipt.zip
+            record.ordering_city = self.values['city']
+            record.province_code = self.values['province']
+            record.origin_date = receipt.origin_date
+            self.assertEqual(template.write(receipt.reference, receipt.street,
+                    receipt.city, receipt.zip, receipt.origin_date),
+                record.write())
+
+    def test_ordering_blocks(self):
+        'Test receipts split in ordering blocks'
+        values = self.values.copy()
+        values['receipts'] = self.receipts
+        values['amount'] = sum(r.amount for r in self.receipts)
+        values['block_size'] = 1
+        lines = csb58.render(values).split(csb58.SEPARATOR)[:-1]
+        self.assertEqual([l[:4] for l in lines], ['5170',
+                '5370', '5670', '5676', '5870',
+                '5370', '5670', '5676', '5870',
+                '5970'])
+        self.assertEqual(len(lines), csb58.record_count(values))
+        # Amount, individual records and records of each block
+        self.assertEqual(lines[4][88:98], '0000001050')
+        self.assertEqual(lines[4][104:124], '00000000020000000004')
+        self.assertEqual(lines[8][88:98], '0123456789')
+        # Blocks, amount, individual records and records of the file
+        self.assertEqual(lines[9][68:72], '0002')
+        self.assertEqual(lines[9][88:98], '0123457839')
+        self.assertEqual(lines[9][104:124], '00000000040000000010')
+
+    def test_count_records(self):
+        'Test records counted from the number of receipts'
+        for include_domicile in (False, True):
+            for block_size in (None, 1, 2, 3):
+                for receipts in (0, 1, 2, 5):
+                    values = self.values.copy()
+                    values['include_domicile'] = include_domicile
+                    values['block_size'] = block_size
+                    values['receipts'] = (self.receipts * 3)[:receipts]
+                    values['amount'] = sum(r.amount
+                        for r in values['receipts'])
+                    self.assertEqual(
+                        csb58.count_records(receipts, include_domicile,
+                            block_size),
+                        len(csb58.render(values).split(csb58.SEPARATOR)) - 1)
+
+    def test_consolidated_records(self):
+        'Test remittances of many suffixes consolidated in a file'
+        values_list = []
+        for suffix, receipt in zip(('000', '001'), self.receipts):
+            values = self.values.copy()
+            values['suffix'] = suffix
+            values['receipts'] = [receipt]
+            values['amount'] = receipt.amount
+            values_list.append(values)
+        lines = list(csb58.iter_consolidated_records(values_list))
+        self.assertEqual([l[:4] for l in lines], ['5170',
+                '5370', '5670', '5676', '5870',
+                '5370', '5670', '5676', '5870',
+                '5970'])
+        # The presenter is the one of the first remittance
+        self.assertEqual(lines[0][13:16], '000')
+        self.assertEqual(lines[5][13:16], '001')
+        self.assertEqual(lines[9][13:16], '000')
+        # Blocks, amount, individual records and records of the file
+        self.assertEqual(lines[9][68:72], '0002')
+        self.assertEqual(lines[9][88:98], '0123457839')
+        self.assertEqual(lines[9][104:124], '00000000040000000010')
+        data = ''.join(l + csb58.SEPARATOR for l in lines)
+        self.assertEqual(csb58.validate(data.encode(csb58.ENCODING)).blocks,
+            2)
+
+    def test_split(self):
+        'Test receipts split in files'
+        values = self.values.copy()
+        values['receipts'] = self.receipts
+        values['amount'] = sum(r.amount for r in self.receipts)
+        chunks = list(csb58.split(values, 1))
+        self.assertEqual([c['receipts'] for c in chunks],
+            [self.receipts[:1], self.receipts[1:]])
+        self.assertEqual([c['amount'] for c in chunks],
+            [r.amount for r in self.receipts])
+
+    def test_iter_returns(self):
+        'Test reading the returned receipts'
+        values = self.values.copy()
+        values['receipts'] = self.receipts
+        values['amount'] = sum(r.amount for r in self.receipts)
+        lines = csb58.render(values).split(csb58.SEPARATOR)
+        # The bank fills the return code of the first receipt
+        lines[2] = lines[2][:98] + 'R01   ' + lines[2][104:]
+        data = csb58.SEPARATOR.join(lines).encode(csb58.ENCODING)
+        self.assertEqual(list(csb58.iter_returns(BytesIO(data))), [
+                csb58.ReturnedReceipt(reference='P1', payment=1,
+                    amount=Decimal('10.5'), return_code='R01'),
+                ])
+
+    def test_validate(self):
+        'Test validating the rendered files'
+        for include_domicile in (False, True):
+            for block_size in (None, 1):
+                for receipts in (self.receipts, []):
+                    values = self.values.copy()
+                    values['include_domicile'] = include_domicile
+                    values['block_size'] = block_size
+                    values['receipts'] = receipts
+                    values['amount'] = sum(r.amount for r in receipts)
+                    data = csb58.render(values).encode(csb58.ENCODING)
+                    self.assertEqual(csb58.validate(data), csb58.FileTotals(
+                            csb58.block_count(values),
+                            len(receipts) * (2 if include_domicile else 1),
+                            csb58.record_count(values), values['amount']))
+        path = csb58.render_to_file(values)
+        try:
+            self.assertEqual(csb58.validate_file(path).records, 4)
+        finally:
+            os.remove(path)
+
+    def test_validate_errors(self):
+        'Test validating inconsistent files'
+        values = self.values.copy()
+        values['receipts'] = self.receipts
+        values['amount'] = sum(r.amount for r in self.receipts)
+        lines = csb58.render(values).split(csb58.SEPARATOR)[:-1]
+
+        def validate(lines):
+            data = ''.join(l + csb58.SEPARATOR for l in lines)
+            csb58.validate(data.encode(csb58.ENCODING))
+
+        for line, invalid in [
+                # Wrong width
+                (3, lines[2] + ' '),
+                # Optional record without required one
+                (3, lines[3]),
+                # Wrong amount of the ordering footer
+                (7, lines[6][:88] + '0000000001' + lines[6][98:]),
+                # Wrong number of records of the presenter footer
+                (8, lines[7][:114] + '0000000009' + lines[7][124:]),
+                # Different presenter
+                (3, lines[2][:13] + '001' + lines[2][16:]),
+                ]:
+            changed = lines[:line - 1] + [invalid] + lines[line:]
+            with self.assertRaises(csb58.InvalidFile) as cm:
+                validate(changed)
+            self.assertEqual(cm.exception.line, line)
+        with self.assertRaises(csb58.InvalidFile) as cm:
+            validate(lines[:-1])
+        self.assertEqual(cm.exception.line, 8)
+        with self.assertRaises(csb58.InvalidFile):
+            validate(lines + lines[-1:])
+        with self.assertRaises(csb58.InvalidFile):
+            validate([])
+
+    def test_normalize(self):
+        'Test normalize'
+        for text, size, result in [
+                (None, None, ''),
+                ('Ñandú Çà', None, 'Nandu Ca'),
+                ('Col·legi+1', None, 'Col-legi-1'),
+                (' Two\n lines ', None, 'Two lines'),
+                ('Truncated', 5, 'Trunc'),
+                ('Euro €', None, 'Euro'),
+                ]:
+            self.assertEqual(csb58.normalize(text, size), result)
+
+    def test_nif(self):
+        'Test nif'
+        for vat_number, result in [
+                ('ESB12345674', 'B12345674'),
+                ('es b12345674', 'B12345674'),
+                ('B12345674', 'B12345674'),
+                ('X1234567L', 'X1234567L'),
+                ]:
+            self.assertEqual(csb58.nif(vat_number), result)
+
+    def test_template_unknown_field(self):
+        'Test template with a field not in the structure'
+        with self.assertRaises(AssertionError):
+            csb58.Template(c58.REQUIRED_INDIVIDUAL_RECORD, ('unknown',))
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
         AccountPaymentEsCsb58TestCase))
-    return suite
\ No newline at end of file
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        Csb58TestCase))
+    return suite